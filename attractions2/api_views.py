@@ -1,14 +1,16 @@
 import dataclasses
+import hashlib
 import http.client
 import json
 import logging
+import math
 import tempfile
 import time
 import uuid
+from collections import defaultdict
 from datetime import datetime, date
-from typing import Type, List, Dict
+from typing import Type, List, Dict, Optional, Set, Tuple
 
-import boto3
 import django.http.request
 import jwt
 import pytz
@@ -16,13 +18,17 @@ from PIL import ExifTags, Image
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.paginator import Paginator
-from django.db.models import Avg, Count, Sum
+from django.db.models import Avg, Count, Q, Sum
 from django.http import HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response
 from django.views.decorators.cache import cache_control, cache_page, never_cache
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import condition
 
-from attractions2 import models, forms, base_models
+from attractions2 import models, forms, base_models, autocomplete, geohash, google_keys, keyset, response_cache, \
+    spatial_index, tiles
+from attractions2.search import search_attractions
+from attractions2.storage import get_storage
 from attractions2.trail import analyze_trail, FileEmpty
 
 log = logging.getLogger(__name__)
@@ -45,99 +51,416 @@ def get_attraction_filter(_request, model: Type[models.AttractionFilter]):
     })
 
 
-def _query_set_to_json(query_set):
-    attractions = list(query_set)
+def _parse_fields(values) -> Optional[Set[str]]:
+    """
+    Parse the fields parameter (fields=id,name,lat,long) which restricts the keys of
+    the documents returned by the list endpoints, None means all the keys
+    """
+    if not values:
+        return None
+
+    if isinstance(values, str):
+        values = [values]
+
+    fields = set()
+    for value in values:
+        fields.update(filter(None, map(str.strip, value.split(","))))
+
+    return fields or None
 
+
+def _row_thumbs(rows: List[base_models.ShortRow]) -> Dict[int, models.ImageAsset]:
     image_ids = set(map(
         lambda x: x.main_image_id,
         filter(
             lambda x: x.main_image_id is not None,
-            attractions
+            rows
         )
     ))
 
-    images = models.ImageAsset.resolve_thumbs(image_ids, 600)
+    return models.ImageAsset.resolve_thumbs(image_ids, 600)
+
+
+def _rows_to_json(rows: List[base_models.ShortRow], fields: Optional[Set[str]],
+                  images: Optional[Dict[int, models.ImageAsset]] = None) -> List[dict]:
+    # Thumbnails are only resolved when the image is requested
+    if fields is not None and "main_image" not in fields:
+        return [row.document for row in rows]
+
+    if images is None:
+        images = _row_thumbs(rows)
 
     items = []
 
-    for attraction in attractions:
-        document = attraction.to_short_json
+    for row in rows:
+        document = row.document
 
-        if attraction.main_image_id is None:
+        if row.main_image_id is None:
             document["main_image"] = None
         else:
-            document["main_image"] = images[attraction.main_image_id].to_json
+            document["main_image"] = images[row.main_image_id].to_json
 
         items.append(document)
 
     return items
 
 
-def _get_explore_query_set(request, model, short: bool):
-    if short:
-        query_set = model.short_query()
-    else:
-        query_set = model.objects.all()
+def _query_set_to_json(model, query_set, fields: Optional[Set[str]] = None) -> List[dict]:
+    return _rows_to_json(model.short_values(query_set, fields), fields)
+
+
+def _paginated_json(model, query_set, sort_field: str, descending: bool, cursor: Optional[str],
+                    limit: Optional[int], fields: Optional[Set[str]]) -> dict:
+    # Without a limit the whole list is returned, as older clients expect
+    if limit is None:
+        return {
+            "status": "ok",
+            model.api_multiple_key(): _query_set_to_json(model, query_set, fields)
+        }
+
+    page = keyset.paginate(
+        query_set,
+        sort_field,
+        descending,
+        cursor,
+        limit,
+        fetch=lambda sliced: model.short_values(sliced, fields, extra=(sort_field,)),
+        position=lambda row: [row.extra[0], row.document["id"]]
+    )
+
+    return {
+        "status": "ok",
+        model.api_multiple_key(): _rows_to_json(page.items, fields),
+        "next_cursor": page.next_cursor
+    }
+
+
+class UnknownFacet(ValueError):
+    pass
+
+
+def _facets_json(model, query_set, names: Set[str]) -> Dict[str, List[dict]]:
+    """
+    The number of results per value of each requested facet, one grouped query per facet
+    """
+    facet_fields = model.facet_fields()
+
+    unknown = names - facet_fields.keys()
+    if unknown:
+        raise UnknownFacet(f"Unknown facets: {', '.join(sorted(unknown))}")
+
+    # The filtered set as a subquery, so a facet doesn't reuse the join of a filter on the
+    # same many to many field (which would only count the filtered values)
+    matching = model.objects.filter(pk__in=query_set.order_by().values("pk"))
+
+    facets = {}
+
+    for name in sorted(names):
+        lookup = facet_fields[name]
+
+        # Distinct since the many to many facets join several rows per attraction
+        counts = matching \
+            .values_list(lookup) \
+            .annotate(count=Count("pk", distinct=True)) \
+            .order_by(lookup)
+
+        facets[name] = [
+            {"id": value, "count": count}
+            for value, count in counts
+            if value is not None
+        ]
+
+    return facets
+
+
+def _invalid_cursor(error: keyset.InvalidCursor) -> JsonResponse:
+    resp = JsonResponse({
+        "status": "error",
+        "code": "InvalidCursor",
+        "message": str(error)
+    })
+    resp.status_code = 400
+
+    return resp
+
+
+def _invalid_limit(error: keyset.InvalidLimit) -> JsonResponse:
+    resp = JsonResponse({
+        "status": "error",
+        "code": "InvalidLimit",
+        "message": str(error)
+    })
+    resp.status_code = 400
+
+    return resp
 
-    return model.explore_filter(query_set, request)
+
+def _get_explore_query_set(request, model):
+    return model.explore_filter(model.short_query(), request)
+
+
+def _get_explore_etag(request, model):
+    return response_cache.get_version(request, model).etag
 
 
 def _get_explore_last_modified(request, model):
-    try:
-        return _get_explore_query_set(request, model, False).latest("date_modified").date_modified
-    except model.DoesNotExist:
-        return None
+    return response_cache.get_version(request, model).last_modified
+
+
+def _explore_json(request, model, limit: Optional[int]) -> dict:
+    query_set = _get_explore_query_set(request, model)
+
+    document = _paginated_json(
+        model,
+        query_set.order_by("name", "id"),
+        "name",
+        False,
+        request.GET.get("cursor"),
+        limit,
+        _parse_fields(request.GET.getlist("fields"))
+    )
+
+    # https://hollyland.iywebs.cloudns.ph/attractions/api/museums?region_id=4&facets=region,domain
+    facets = _parse_fields(request.GET.getlist("facets"))
+    if facets is not None:
+        document["facets"] = _facets_json(model, query_set, facets)
+
+    return document
 
 
 # cache explore for 2 hours
 @cache_control(public=True, max_age=60 * 60 * 2)
-@condition(last_modified_func=_get_explore_last_modified)
+@condition(etag_func=_get_explore_etag, last_modified_func=_get_explore_last_modified)
 def get_explore(request, model):
-    return JsonResponse({
-        "status": "ok",
-        model.api_multiple_key(): _query_set_to_json(
-            _get_explore_query_set(request, model, True).order_by("name")
+    try:
+        limit = keyset.parse_limit(request.GET.get("limit"))
+
+        return response_cache.cached_response(
+            request,
+            response_cache.explore_key(request, model),
+            lambda: _explore_json(request, model, limit)
         )
-    })
+    except keyset.InvalidCursor as e:
+        return _invalid_cursor(e)
+    except keyset.InvalidLimit as e:
+        return _invalid_limit(e)
+    except UnknownFacet as e:
+        resp = JsonResponse({
+            "status": "error",
+            "code": "UnknownFacet",
+            "message": str(e)
+        })
+        resp.status_code = 400
 
+        return resp
+
+
+class UnknownCategory(ValueError):
+    pass
+
+
+def _parse_categories(values) -> List[Type[models.Attraction]]:
+    """
+    Parse the categories parameter of the combined explore (categories=museums,wineries),
+    all the categories are returned when it's missing
+    """
+    classes = {
+        subclass.api_multiple_key(): subclass
+        for subclass in models.get_attraction_classes()
+    }
+
+    keys = []
+    for value in values:
+        keys.extend(filter(None, map(str.strip, value.split(","))))
+
+    if not keys:
+        return list(classes.values())
+
+    categories = []
+    for key in keys:
+        if key not in classes:
+            raise UnknownCategory(f"Unknown category: {key}")
+
+        if classes[key] not in categories:
+            categories.append(classes[key])
+
+    return categories
+
+
+class InvalidBounds(ValueError):
+    pass
+
+
+def _parse_bbox(request) -> Dict[str, float]:
+    """
+    The lookups of the bounding box parameters of the combined explore
+    (https://hollyland.iywebs.cloudns.ph/attractions/api/explore?lat_min=31.5&lat_max=32&lon_min=34.7&lon_max=35)
+    """
+    lookups = {}
+
+    for param, lookup in (("lat_min", "lat__gte"), ("lat_max", "lat__lte"),
+                          ("lon_min", "long__gte"), ("lon_max", "long__lte")):
+        if param in request.GET:
+            try:
+                value = float(request.GET[param])
+            except ValueError:
+                value = math.nan
 
-def _get_single_last_modified(_request, model, attraction_id: int):
+            if not math.isfinite(value):
+                raise InvalidBounds(f"{param} must be a finite number")
+
+            lookups[lookup] = value
+
+    return lookups
+
+
+def _get_combined_explore_etag(request):
     try:
-        return model.objects.get(id=attraction_id).date_modified
-    except model.DoesNotExist:
+        return response_cache.combined_etag(request, _parse_categories(request.GET.getlist("categories")))
+    except UnknownCategory:
         return None
 
 
-# cache single for 2 hours
+def _get_combined_explore_last_modified(request):
+    try:
+        return response_cache.combined_last_modified(
+            request,
+            _parse_categories(request.GET.getlist("categories"))
+        )
+    except UnknownCategory:
+        return None
+
+
+def _combined_explore_json(request, categories: List[Type[models.Attraction]], limit: Optional[int],
+                           fields: Optional[Set[str]], bbox: Dict[str, float]) -> dict:
+    rows = {}
+
+    for model in categories:
+        query_set = _get_explore_query_set(request, model).filter(**bbox).order_by("name", "id")
+
+        if limit is not None:
+            query_set = query_set[:limit]
+
+        rows[model] = model.short_values(query_set, fields)
+
+    # One thumbnail lookup for all the categories
+    images = None
+    if fields is None or "main_image" in fields:
+        images = _row_thumbs([row for model_rows in rows.values() for row in model_rows])
+
+    document = {"status": "ok"}
+    for model, model_rows in rows.items():
+        document[model.api_multiple_key()] = _rows_to_json(model_rows, fields, images)
+
+    return document
+
+
+# cache explore for 2 hours
 @cache_control(public=True, max_age=60 * 60 * 2)
-@condition(last_modified_func=_get_single_last_modified)
-def get_single(_request, model, attraction_id: int):
+@condition(etag_func=_get_combined_explore_etag, last_modified_func=_get_combined_explore_last_modified)
+def combined_explore(request):
+    """
+    Several explore lists in one response. The lat_min, lat_max, lon_min, lon_max
+    bounding box applies to every category, region_id to the categories which have a
+    region (not trails and tours, which are listed whatever the region)
+    """
     try:
-        single = model.objects.get(id=attraction_id)
-        document = single.to_json
+        categories = _parse_categories(request.GET.getlist("categories"))
+        limit = keyset.parse_limit(request.GET.get("limit"))
+        bbox = _parse_bbox(request)
+    except UnknownCategory as e:
+        resp = JsonResponse({
+            "status": "error",
+            "code": "UnknownCategory",
+            "message": str(e)
+        })
+        resp.status_code = 400
 
-        image_ids = set()
-        if single.main_image_id is not None:
-            image_ids.add(single.main_image_id)
+        return resp
+    except InvalidBounds as e:
+        resp = JsonResponse({
+            "status": "error",
+            "code": "InvalidBounds",
+            "message": str(e)
+        })
+        resp.status_code = 400
 
-        additional_images = list(single.additional_images.values_list('pk', flat=True))
-        image_ids.update(additional_images)
+        return resp
+    except keyset.InvalidCursor as e:
+        return _invalid_cursor(e)
+    except keyset.InvalidLimit as e:
+        return _invalid_limit(e)
+
+    return response_cache.cached_response(
+        request,
+        response_cache.combined_explore_key(request, categories),
+        lambda: _combined_explore_json(
+            request,
+            categories,
+            limit,
+            _parse_fields(request.GET.getlist("fields")),
+            bbox
+        )
+    )
 
-        images = models.ImageAsset.resolve_thumbs(image_ids, 900)
 
-        if single.main_image_id is None:
-            document["main_image"] = None
-        else:
-            document["main_image"] = images[single.main_image_id].to_json
+def _get_single_etag(request, model, attraction_id: int):
+    return response_cache.get_version(request, model).etag
 
-        document["additional_images"] = list(map(
-            lambda image_id: images[image_id].to_json,
-            additional_images
-        ))
 
+def _get_single_last_modified(request, model, attraction_id: int):
+    return response_cache.get_version(request, model).last_modified
+
+
+def _detail_image_ids(single: models.Attraction) -> Set[int]:
+    image_ids = {image.pk for image in single.additional_images.all()}
+
+    if single.main_image_id is not None:
+        image_ids.add(single.main_image_id)
+
+    return image_ids
+
+
+def _detail_json(single: models.Attraction, images: Dict[int, models.ImageAsset]) -> dict:
+    """
+    The detail document of an attraction loaded by detail_query, with the thumbnails
+    resolved for _detail_image_ids
+    """
+    document = single.to_json
+
+    if single.main_image_id is None:
+        document["main_image"] = None
+    else:
+        document["main_image"] = images[single.main_image_id].to_json
+
+    document["additional_images"] = list(map(
+        lambda image: images[image.pk].to_json,
+        single.additional_images.all()
+    ))
+
+    return document
+
+
+def _build_detail(model, attraction_id: int) -> Tuple[dict, Set[str]]:
+    single = model.detail_query().get(id=attraction_id)
+
+    images = models.ImageAsset.resolve_thumbs(_detail_image_ids(single), 900)
+
+    return _detail_json(single, images), response_cache.detail_dependencies(single)
+
+
+# cache single for 2 hours
+@cache_control(public=True, max_age=60 * 60 * 2)
+@condition(etag_func=_get_single_etag, last_modified_func=_get_single_last_modified)
+def get_single(_request, model, attraction_id: int):
+    try:
         return JsonResponse({
             "status": "ok",
-            model.api_single_key(): document
+            model.api_single_key(): response_cache.cached_detail(
+                model,
+                attraction_id,
+                lambda: _build_detail(model, attraction_id)
+            )
         })
     except model.DoesNotExist:
         resp = JsonResponse({
@@ -150,6 +473,103 @@ def get_single(_request, model, attraction_id: int):
         return resp
 
 
+# Upper bound for the number of ids of a details request
+MAX_DETAILS = 50
+
+# Ids are 64 bit in the database, larger numbers fail the query
+MAX_ID = 2 ** 63 - 1
+
+
+def _parse_ids(values) -> List[int]:
+    attraction_ids = []
+
+    for value in values:
+        attraction_ids.extend(int(part) for part in value.split(",") if part.strip())
+
+    if any(not -MAX_ID <= attraction_id <= MAX_ID for attraction_id in attraction_ids):
+        raise ValueError("id out of range")
+
+    # Without duplicates, in the requested order
+    return list(dict.fromkeys(attraction_ids))
+
+
+# cache details for 2 hours
+@cache_control(public=True, max_age=60 * 60 * 2)
+def get_details(request):
+    """
+    The detail documents of several attractions of any category
+    (https://hollyland.iywebs.cloudns.ph/attractions/api/details?ids=4,17,23), in the order of the ids.
+    Unknown ids are listed in missing.
+    """
+    try:
+        attraction_ids = _parse_ids(request.GET.getlist("ids"))
+    except ValueError:
+        attraction_ids = None
+
+    if not attraction_ids or len(attraction_ids) > MAX_DETAILS:
+        resp = JsonResponse({
+            "status": "error",
+            "code": "InvalidIds",
+            "message": f"ids must be a list of 1 to {MAX_DETAILS} attraction ids"
+        })
+        resp.status_code = 400
+
+        return resp
+
+    attraction_models = {
+        attraction_id: ContentType.objects.get_for_id(content_type_id).model_class()
+        for attraction_id, content_type_id in models.Attraction.objects.filter(
+            id__in=attraction_ids,
+            content_type__isnull=False
+        ).values_list("id", "content_type_id")
+    }
+
+    documents = {
+        attraction_id: document
+        for (_, attraction_id), document in response_cache.cached_details([
+            (model, attraction_id) for attraction_id, model in attraction_models.items()
+        ]).items()
+    }
+
+    # The rest is loaded with one detail query per category and a single thumbnail lookup
+    missing = defaultdict(list)
+    for attraction_id, model in attraction_models.items():
+        if attraction_id not in documents:
+            missing[model].append(attraction_id)
+
+    generation = response_cache.detail_generation() if missing else None
+
+    loaded = [
+        single
+        for model, model_ids in missing.items()
+        for single in model.detail_query().filter(id__in=model_ids)
+    ]
+
+    image_ids = set()
+    for single in loaded:
+        image_ids.update(_detail_image_ids(single))
+
+    images = models.ImageAsset.resolve_thumbs(image_ids, 900)
+
+    for single in loaded:
+        document = _detail_json(single, images)
+        response_cache.store_detail(
+            type(single),
+            single.id,
+            document,
+            response_cache.detail_dependencies(single),
+            generation
+        )
+
+        documents[single.id] = document
+
+    return JsonResponse({
+        "status": "ok",
+        "attractions": [documents[attraction_id] for attraction_id in attraction_ids if attraction_id in documents],
+        "missing": [attraction_id for attraction_id in attraction_ids if attraction_id not in documents]
+    })
+
+
 @csrf_exempt
 def login(request):
     if request.method != "POST":
@@ -158,8 +578,7 @@ def login(request):
     data = json.loads(request.body)
     token = data["token"]
 
-    jwks_client = jwt.PyJWKClient("https://www.googleapis.com/oauth2/v3/certs")
-    signing_key = jwks_client.get_signing_key_from_jwt(token)
+    signing_key = google_keys.get_keys().get_signing_key_from_jwt(token)
 
     data = jwt.decode(
         token,
@@ -358,49 +777,303 @@ def favorites(request: UserRequest):
 
 @with_user_id
 def history_list(request: UserRequest, model):
-    return JsonResponse({
-        "status": "ok",
-        model.api_multiple_key(): _query_set_to_json(
-            model.history(request.user_id)
-        )
-    })
+    try:
+        return JsonResponse(_paginated_json(
+            model,
+            model.history(request.user_id),
+            "last_visited",
+            True,
+            request.data.get("cursor"),
+            keyset.parse_limit(request.data.get("limit")),
+            _parse_fields(request.data.get("fields"))
+        ))
+    except keyset.InvalidCursor as e:
+        return _invalid_cursor(e)
+    except keyset.InvalidLimit as e:
+        return _invalid_limit(e)
 
 
 @with_user_id
 def favorites_list(request: UserRequest, model):
-    return JsonResponse({
+    try:
+        return JsonResponse(_paginated_json(
+            model,
+            model.favorite(request.user_id),
+            "favorite_created",
+            True,
+            request.data.get("cursor"),
+            keyset.parse_limit(request.data.get("limit")),
+            _parse_fields(request.data.get("fields"))
+        ))
+    except keyset.InvalidCursor as e:
+        return _invalid_cursor(e)
+    except keyset.InvalidLimit as e:
+        return _invalid_limit(e)
+
+
+# Below this zoom level crowded maps are clustered
+MAP_CLUSTER_MAX_ZOOM = 15
+
+# Attractions are returned one by one up to this many in the view
+MAP_CLUSTER_THRESHOLD = 300
+
+# Cluster cells are a quarter of a 256px map tile (64px) wide
+MAP_CLUSTER_CELLS_PER_TILE = 4
+
+
+def _map_content_types(objects: Optional[str]) -> Optional[Set[int]]:
+    if objects == "attractions":
+        return {
+            content_type.id
+            for model, content_type in ContentType.objects.get_for_models(*models.get_attraction_classes()).items()
+            if model not in (models.Trail, models.Tour)
+        }
+    elif objects == "trails":
+        return {ContentType.objects.get_for_model(models.Trail).id}
+
+    return None
+
+
+def _map_json(entries: List[spatial_index.Entry], zoom: Optional[int], fields: Optional[Set[str]]) -> dict:
+    """
+    The attractions of the spatial index entries, or at low zoom levels when there are more
+    than MAP_CLUSTER_THRESHOLD of them, grid clusters with their count and centroid.
+    A cluster of a single attraction is returned as the attraction itself.
+    """
+    if zoom is None or zoom >= MAP_CLUSTER_MAX_ZOOM or len(entries) <= MAP_CLUSTER_THRESHOLD:
+        single_ids = [entry.id for entry in entries]
+        clusters = None
+    else:
+        cell = 360 / 2 ** zoom / MAP_CLUSTER_CELLS_PER_TILE
+
+        grid = defaultdict(list)
+        for entry in entries:
+            grid[(math.floor(entry.long / cell), math.floor(entry.lat / cell))].append(entry)
+
+        single_ids = []
+        clusters = []
+
+        for grid_entries in grid.values():
+            if len(grid_entries) == 1:
+                single_ids.append(grid_entries[0].id)
+            else:
+                clusters.append({
+                    "lat": sum(entry.lat for entry in grid_entries) / len(grid_entries),
+                    "long": sum(entry.long for entry in grid_entries) / len(grid_entries),
+                    "count": len(grid_entries),
+                })
+
+    # Only the returned rows are read from the database
+    document = {
         "status": "ok",
-        model.api_multiple_key(): _query_set_to_json(
-            model.favorite(request.user_id)
+        "attractions": _query_set_to_json(
+            models.Attraction,
+            models.Attraction.objects.filter(id__in=single_ids),
+            fields
         )
-    })
+    }
+
+    if clusters is not None:
+        document["clusters"] = clusters
+
+    return document
 
 
 @never_cache
 def map_attractions(request):
-    lon_min = float(request.GET["lon_min"])
-    lon_max = float(request.GET["lon_max"])
-    lat_min = float(request.GET["lat_min"])
-    lat_max = float(request.GET["lat_max"])
+    try:
+        lon_min, lon_max, lat_min, lat_max = (
+            float(request.GET[param])
+            for param in ("lon_min", "lon_max", "lat_min", "lat_max")
+        )
+
+        if not all(map(math.isfinite, (lon_min, lon_max, lat_min, lat_max))):
+            raise ValueError()
+    except (KeyError, ValueError):
+        resp = JsonResponse({
+            "status": "error",
+            "code": "InvalidBounds",
+            "message": "lon_min, lon_max, lat_min and lat_max must be finite numbers"
+        })
+        resp.status_code = 400
+
+        return resp
+
+    # https://hollyland.iywebs.cloudns.ph/attractions/api/map?lon_min=34&lon_max=36&lat_min=29&lat_max=34&zoom=8
+    zoom = None
+    if "zoom" in request.GET:
+        try:
+            zoom = min(max(int(request.GET["zoom"]), 0), tiles.MAX_ZOOM)
+        except ValueError:
+            resp = JsonResponse({
+                "status": "error",
+                "code": "InvalidZoom",
+                "message": f"zoom must be a number, the zoom level goes up to {tiles.MAX_ZOOM}"
+            })
+            resp.status_code = 400
+
+            return resp
+
+    entries = spatial_index.get_index().query(
+        lon_min,
+        lat_min,
+        lon_max,
+        lat_max,
+        _map_content_types(request.GET.get("objects"))
+    )
+
+    return JsonResponse(_map_json(entries, zoom, _parse_fields(request.GET.getlist("fields"))))
+
+
+# Tiles are revalidated with their ETag once they expire
+@cache_control(public=True, max_age=60 * 60 * 24)
+def get_tile(request, z: int, x: int, y: int):
+    """
+    The attractions (or clusters) of a slippy map tile, like map_attractions with the
+    zoom level of the tile (https://hollyland.iywebs.cloudns.ph/attractions/api/tiles/8/152/104)
+    """
+    if not tiles.is_valid(z, x, y):
+        resp = JsonResponse({
+            "status": "error",
+            "code": "InvalidTile",
+            "message": f"There is no tile {z}/{x}/{y}, the zoom level goes up to {tiles.MAX_ZOOM}"
+        })
+        resp.status_code = 404
+
+        return resp
+
+    def build():
+        # Half open, so a point on an edge belongs to a single tile. The tile is cached
+        # until the next change in it, so it must include the latest changes
+        entries = spatial_index.get_index().query(
+            *tiles.bounds(z, x, y),
+            _map_content_types(request.GET.get("objects")),
+            refresh=True,
+            half_open=True
+        )
+
+        return _map_json(entries, z, _parse_fields(request.GET.getlist("fields")))
+
+    response = response_cache.cached_response(request, response_cache.tile_key(request, z, x, y), build)
+
+    # Strong, the hash of the exact bytes (compressed or not) that are sent
+    response["ETag"] = '"' + hashlib.sha1(response.content).hexdigest() + '"'
+
+    return get_conditional_response(request, etag=response["ETag"], response=response)
+
+
+# Cells of about 1km, the k nearest search starts there and moves to coarser cells
+NEARBY_START_RADIUS = 1000
+
+NEARBY_DEFAULT_LIMIT = 20
+
+
+def _nearby_candidates(query_set, lat: float, long: float, precision: int) -> List[tuple]:
+    """
+    (distance, id) of the attractions in the cell of the point and its neighbours, sorted by distance
+    """
+    if precision > 0:
+        cells = Q()
+        for cell in geohash.neighbours(lat, long, precision):
+            cells |= Q(geohash__gte=cell, geohash__lt=geohash.prefix_end(cell))
+
+        query_set = query_set.filter(cells)
+
+    return sorted(
+        (geohash.distance(lat, long, row_lat, row_long), row_id)
+        for row_id, row_lat, row_long in query_set.values_list("id", "lat", "long")
+    )
+
+
+def _nearest(query_set, lat: float, long: float, limit: int, radius: Optional[float]) -> List[tuple]:
+    if radius is not None:
+        candidates = _nearby_candidates(query_set, lat, long, geohash.precision_for(radius, lat))
+
+        return [candidate for candidate in candidates if candidate[0] <= radius][:limit]
+
+    precision = geohash.precision_for(NEARBY_START_RADIUS, lat)
+
+    while True:
+        candidates = _nearby_candidates(query_set, lat, long, precision)
+
+        if precision == 0:
+            return candidates[:limit]
+
+        # Only the points closer than a cell width are sure to be the nearest ones,
+        # something farther may be just outside the searched cells
+        reach = geohash.cell_span(lat, precision)
+        found = [candidate for candidate in candidates if candidate[0] <= reach]
+
+        if len(found) >= limit:
+            return found[:limit]
+
+        precision -= 1
+
+
+def nearby(request):
+    """
+    The attractions closest to a point sorted by distance, either the k (limit) nearest or
+    the ones within radius meters. categories restricts the attraction types like in explore
+    """
+    try:
+        lat = float(request.GET["lat"])
+        long = float(request.GET["long"])
+        radius = float(request.GET["radius"]) if "radius" in request.GET else None
+
+        if not (-90 <= lat <= 90 and -180 <= long <= 180) or \
+                (radius is not None and not (math.isfinite(radius) and radius > 0)):
+            raise ValueError()
+    except (KeyError, ValueError):
+        resp = JsonResponse({
+            "status": "error",
+            "code": "InvalidLocation",
+            "message": "lat and long are required, radius must be a positive number of meters"
+        })
+        resp.status_code = 400
+
+        return resp
+
+    try:
+        categories = _parse_categories(request.GET.getlist("categories"))
+        limit = keyset.parse_limit(request.GET.get("limit")) or NEARBY_DEFAULT_LIMIT
+    except UnknownCategory as e:
+        resp = JsonResponse({
+            "status": "error",
+            "code": "UnknownCategory",
+            "message": str(e)
+        })
+        resp.status_code = 400
+
+        return resp
+    except keyset.InvalidCursor as e:
+        return _invalid_cursor(e)
+    except keyset.InvalidLimit as e:
+        return _invalid_limit(e)
 
     query_set = models.Attraction.objects.filter(
-        long__gte=lon_min,
-        long__lte=lon_max,
-        lat__gte=lat_min,
-        lat__lte=lat_max,
-        content_type__isnull=False
-    ).select_related("content_type")
-
-    if request.GET.get("objects") == "attractions":
-        query_set = query_set \
-            .exclude(content_type=ContentType.objects.get_for_model(models.Trail)) \
-            .exclude(content_type=ContentType.objects.get_for_model(models.Tour))
-    elif request.GET.get("objects") == "trails":
-        query_set = query_set.filter(content_type=ContentType.objects.get_for_model(models.Trail))
+        content_type__in=ContentType.objects.get_for_models(*categories).values()
+    )
+
+    nearest = _nearest(query_set, lat, long, limit, radius)
+
+    fields = _parse_fields(request.GET.getlist("fields"))
+    rows = {
+        row.document["id"]: row
+        for row in models.Attraction.short_values(
+            models.Attraction.objects.filter(id__in=[attraction_id for _, attraction_id in nearest]),
+            fields
+        )
+    }
+
+    ordered = [rows[attraction_id] for _, attraction_id in nearest]
+    attractions = _rows_to_json(ordered, fields)
+
+    for document, (distance, _) in zip(attractions, nearest):
+        document["distance"] = round(distance)
 
     return JsonResponse({
         "status": "ok",
-        "attractions": _query_set_to_json(query_set)
+        "attractions": attractions
     })
 
 
@@ -456,17 +1129,15 @@ def upload_start(request):
 
     trail.save()
 
-    s3 = boto3.client("s3", **settings.ASSETS["config"])
-    key = settings.ASSETS["prefix"] + "trails/" + str(trail.id) + ".csv.gz"
-    bucket = settings.ASSETS["bucket"]
+    storage = get_storage()
 
     request.FILES["file"].seek(0)
-    s3.upload_fileobj(request.FILES["file"], bucket, key, ExtraArgs={
-        "ContentType": "text/csv",
-        "ContentEncoding": "gzip",
-        "ACL": "public-read",
-        "CacheControl": "public, max-age=2592000"
-    })
+    storage.upload(
+        request.FILES["file"],
+        storage.trail_key(trail.id),
+        content_type="text/csv",
+        content_encoding="gzip"
+    )
 
     # Add any additional image to the trail
     for additional_image in images[1:]:
@@ -565,9 +1236,11 @@ def upload_image(request):
 
             image.image = rotated
 
+        # Only the exact same file, a similar picture of another user isn't this one
         image_asset = models.ImageAsset.upload_file(
             image,
-            old_asset=None
+            old_asset=None,
+            perceptual=False
         )
 
         user_image = models.UserImage(
@@ -713,30 +1386,115 @@ def get_comments(_request, attraction_id: int, page_number: int) -> JsonResponse
     })
 
 
+# count=true counts the search results up to this many
+SEARCH_COUNT_CAP = 1000
+
+
+def _search_page_json(results, cursor: Optional[str], limit: int, fields: Optional[Set[str]], count: bool) -> dict:
+    page = keyset.paginate(
+        results.query_set,
+        results.sort_field,
+        results.descending,
+        cursor,
+        limit,
+        fetch=lambda sliced: models.Attraction.short_values(sliced, fields, extra=(results.sort_field,)),
+        position=lambda row: [row.extra[0], row.document["id"]]
+    )
+
+    document = {
+        "items": _rows_to_json(page.items, fields),
+        "has_more": page.next_cursor is not None,
+        "next_cursor": page.next_cursor
+    }
+
+    if count:
+        # Stops after the cap instead of counting every match
+        counted = results.query_set.order_by().values("pk")[:SEARCH_COUNT_CAP + 1].count()
+
+        document["count"] = min(counted, SEARCH_COUNT_CAP)
+        document["count_capped"] = counted > SEARCH_COUNT_CAP
+
+    return document
+
+
 @cache_control(public=True, max_age=60 * 60 * 2)
 def search(request):
+    """
+    Attractions matching q. With limit (and the cursor of the previous page) pages are
+    fetched by keyset without counting the results, page keeps the numbered pages
+    """
     q = request.GET.get("q", "")
+    fields = _parse_fields(request.GET.getlist("fields"))
+    results = search_attractions(q)
+
+    if "page" not in request.GET and ("limit" in request.GET or "cursor" in request.GET):
+        try:
+            return JsonResponse({
+                "status": "ok",
+                "page": _search_page_json(
+                    results,
+                    request.GET.get("cursor"),
+                    keyset.parse_limit(request.GET.get("limit")) or 30,
+                    fields,
+                    request.GET.get("count") == "true"
+                )
+            })
+        except keyset.InvalidCursor as e:
+            return _invalid_cursor(e)
+        except keyset.InvalidLimit as e:
+            return _invalid_limit(e)
+
     page_number = 1
 
     if "page" in request.GET:
         page_number = int(request.GET["page"])
 
-    paginator = Paginator(
-        models.Attraction.objects.filter(name__icontains=q).select_related("content_type"),
-        30
-    )
+    paginator = Paginator(results.query_set, 30)
 
     page = paginator.page(page_number)
 
     return JsonResponse({
         "status": "ok",
         "page": {
-            "items": _query_set_to_json(page.object_list),
+            "items": _query_set_to_json(models.Attraction, page.object_list, fields),
             "num_pages": paginator.num_pages
         }
     })
 
 
+# Suggestions returned by default, and at most
+SUGGEST_DEFAULT_LIMIT = 10
+SUGGEST_MAX_LIMIT = 20
+
+
+def suggest(request):
+    """
+    Search as you type: attraction and filter names matching q from the in-memory
+    autocomplete index
+    """
+    try:
+        limit = int(request.GET.get("limit", SUGGEST_DEFAULT_LIMIT))
+
+        if limit < 1:
+            raise ValueError()
+    except ValueError:
+        resp = JsonResponse({
+            "status": "error",
+            "code": "InvalidLimit",
+            "message": "limit must be a positive number"
+        })
+        resp.status_code = 400
+
+        return resp
+
+    suggestions = autocomplete.get_index().suggest(request.GET.get("q", ""), min(limit, SUGGEST_MAX_LIMIT))
+
+    return JsonResponse({
+        "status": "ok",
+        "suggestions": [suggestion.to_json() for suggestion in suggestions]
+    })
+
+
 @csrf_exempt
 def availability(request, tour_id: int, year: int, month: int):
     if request.method == "POST":
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class Attractions2Config(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'attractions2'
+
+    def ready(self):
+        # Connect the cache invalidation receivers
+        from attractions2 import signals  # noqa: F401
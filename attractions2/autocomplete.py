@@ -0,0 +1,199 @@
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from django.contrib.contenttypes.models import ContentType
+
+from attractions2 import models
+from attractions2.base_models import AttractionFilter
+
+# ContentVersion bumped by attractions2.signals when a name is added, renamed or removed
+VERSION_KEY = "suggestions"
+
+# How often (in seconds) the version is checked
+REFRESH_INTERVAL = 5
+
+# Prefix matches looked at before ranking, short prefixes match many names
+MAX_PREFIX_MATCHES = 200
+
+# Share of the trigrams of the query a name must contain to be suggested, names are
+# longer than what's typed so it's compared to their words (like pg_trgm word_similarity)
+TRIGRAM_THRESHOLD = 0.5
+
+_WORD = re.compile(r"\w+")
+
+
+class Suggestion(NamedTuple):
+    id: int
+    name: str
+    # api_single_key of the attraction, or api_multiple_key of the filter
+    type: str
+    is_filter: bool
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "filter" if self.is_filter else "type": self.type,
+        }
+
+
+def normalize(text: str) -> str:
+    """
+    Lower case words without diacritics (or niqqud) separated by single spaces
+    """
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+
+    return " ".join(_WORD.findall(text))
+
+
+def trigrams(text: str) -> Set[str]:
+    # Words padded like pg_trgm, so the beginning of a word counts twice
+    return {
+        padded[i:i + 3]
+        for word in text.split()
+        for padded in ["  " + word + " "]
+        for i in range(len(padded) - 2)
+    }
+
+
+class _Snapshot(NamedTuple):
+    suggestions: List[Suggestion]
+    # Normalized names of the suggestions
+    names: List[str]
+    # Sorted name suffixes, and the suggestion each one belongs to
+    keys: List[str]
+    key_suggestions: List[int]
+    # Suggestions containing each trigram
+    postings: Dict[str, List[int]]
+
+
+class SuggestIndex:
+    """
+    Attraction and filter names for search as you type: a sorted array of the name
+    suffixes starting at every word for prefix lookups, and trigram postings for
+    names with typos
+    """
+
+    def __init__(self):
+        self.snapshot = _Snapshot([], [], [], [], {})
+        self.version = None  # type: Optional[int]
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def _load(self) -> List[Suggestion]:
+        suggestions = []
+
+        for attraction_id, name, content_type_id in models.Attraction.objects \
+                .filter(content_type__isnull=False) \
+                .values_list("id", "name", "content_type_id") \
+                .iterator():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            suggestions.append(Suggestion(attraction_id, name, model.api_single_key(), False))
+
+        for model in AttractionFilter.__subclasses__():
+            for filter_id, name in model.objects.values_list("id", "name"):
+                suggestions.append(Suggestion(filter_id, name, model.api_multiple_key(), True))
+
+        return suggestions
+
+    def build(self, version: int):
+        suggestions = self._load()
+
+        names = [normalize(suggestion.name) for suggestion in suggestions]
+        keys = []
+        postings = defaultdict(list)
+
+        for i, name in enumerate(names):
+            # "israel museum" is found by "isr" and by "mus"
+            keys.append((name, i))
+            keys.extend((name[match.end():], i) for match in re.finditer(" ", name))
+
+            for trigram in trigrams(name):
+                postings[trigram].append(i)
+
+        keys.sort()
+
+        # Swapped in at once, lookups without the lock see either the old or the new index
+        self.snapshot = _Snapshot(
+            suggestions,
+            names,
+            [key for key, _ in keys],
+            [i for _, i in keys],
+            dict(postings),
+        )
+        self.version = version
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+
+        if self.version is not None and now - self.checked < REFRESH_INTERVAL:
+            return
+
+        with self.lock:
+            if self.version is None or now - self.checked >= REFRESH_INTERVAL:
+                version = models.ContentVersion.lookup(VERSION_KEY).version
+
+                if version != self.version:
+                    self.build(version)
+
+                self.checked = now
+
+    @staticmethod
+    def _prefix(snapshot: _Snapshot, q: str) -> List[Suggestion]:
+        keys, names = snapshot.keys, snapshot.names
+        found = set()  # type: Set[int]
+
+        for i in range(bisect.bisect_left(keys, q), len(keys)):
+            if not keys[i].startswith(q) or len(found) >= MAX_PREFIX_MATCHES:
+                break
+
+            found.add(snapshot.key_suggestions[i])
+
+        # Names starting with the query first, then the shortest (closest) ones
+        def key(index: int):
+            return not names[index].startswith(q), len(names[index]), names[index]
+
+        return [snapshot.suggestions[index] for index in sorted(found, key=key)]
+
+    @staticmethod
+    def _fuzzy(snapshot: _Snapshot, q: str) -> List[Suggestion]:
+        query_trigrams = trigrams(q)
+        shared = Counter(index for trigram in query_trigrams for index in snapshot.postings.get(trigram, ()))
+
+        scored = []
+        for index, count in shared.items():
+            similarity = count / len(query_trigrams)
+
+            if similarity >= TRIGRAM_THRESHOLD:
+                name = snapshot.names[index]
+                scored.append((-similarity, len(name), name, index))
+
+        return [snapshot.suggestions[index] for *_, index in sorted(scored)]
+
+    def suggest(self, q: str, limit: int) -> List[Suggestion]:
+        """
+        Names starting with q (or with a word starting with it), the ones similar to q
+        when there aren't any
+        """
+        self._ensure_fresh()
+
+        q = normalize(q)
+        if not q:
+            return []
+
+        snapshot = self.snapshot
+
+        return (self._prefix(snapshot, q) or self._fuzzy(snapshot, q))[:limit]
+
+
+_index = SuggestIndex()
+
+
+def get_index() -> SuggestIndex:
+    return _index
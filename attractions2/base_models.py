@@ -1,20 +1,96 @@
+import base64
+import dataclasses
+import functools
+import hashlib
 import io
 import logging
+import operator
 import tempfile
 import uuid
 from os import path
-from typing import List, Optional, Set, Dict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
-import boto3
-import requests
 from PIL import Image
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models import Q
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import connection, models
+from django.db.models import F, Q, Value
+from django.db.models.functions import Substr
+
+from attractions2 import geohash
+from attractions2.storage import get_storage
 
 log = logging.getLogger(__name__)
 
+# Text search configuration, "simple" doesn't stem so Hebrew and English names work alike
+SEARCH_CONFIG = "simple"
+
+# Size of the low quality preview clients render until the real image arrives
+PLACEHOLDER_SIZE = 16
+
+
+def create_placeholder(im: Image.Image) -> str:
+    """
+    Create a tiny base64 encoded JPEG preview of the image
+    """
+    preview = im.convert("RGB")
+    preview.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.BICUBIC)
+
+    with io.BytesIO() as fh:
+        preview.save(fh, "JPEG", quality=60, optimize=True)
+        return base64.b64encode(fh.getvalue()).decode("ascii")
+
+
+def file_digest(fh) -> str:
+    """
+    sha256 of the file contents, the file is read in chunks and rewound afterwards
+    """
+    digest = hashlib.sha256()
+
+    fh.seek(0)
+    for chunk in iter(lambda: fh.read(64 * 1024), b""):
+        digest.update(chunk)
+    fh.seek(0)
+
+    return digest.hexdigest()
+
+
+def difference_hash(im: Image.Image) -> str:
+    """
+    64 bit difference hash (dHash) as 16 hex digits, visually similar images
+    have a small hamming distance between their hashes
+    """
+    small = im.convert("L").resize((9, 8), Image.BICUBIC)
+    pixels = list(small.getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+
+    return f"{value:016x}"
+
+
+def hamming_distance(hash1: str, hash2: str) -> int:
+    return bin(int(hash1, 16) ^ int(hash2, 16)).count("1")
+
+
+def _hash_parts(phash: str, count: int) -> List[Tuple[int, str]]:
+    """
+    The (offset, digits) of count consecutive parts of phash of nearly equal length
+    """
+    size, longer = divmod(len(phash), count)
+    parts = []
+    start = 0
+
+    for i in range(count):
+        end = start + size + (1 if i < longer else 0)
+        parts.append((start, phash[start:end]))
+        start = end
+
+    return parts
+
 
 class ImageAsset(models.Model):
     bucket = models.CharField(max_length=250)
@@ -25,6 +101,13 @@ class ImageAsset(models.Model):
     width = models.PositiveIntegerField()
     height = models.PositiveIntegerField()
     parent = models.ForeignKey('ImageAsset', on_delete=models.CASCADE, null=True)
+    # Base64 encoded JPEG of at most PLACEHOLDER_SIZE pixels, see create_placeholder
+    placeholder = models.TextField(blank=True, null=True)
+    # Only set for originals, used to reuse an existing asset when the same image is uploaded again
+    content_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    perceptual_hash = models.CharField(max_length=16, blank=True, null=True)
+    # Number of uploads sharing this asset, the objects are only deleted when it drops to 0
+    ref_count = models.PositiveIntegerField(default=1)
 
     class Meta:
         unique_together = [
@@ -44,8 +127,14 @@ class ImageAsset(models.Model):
             "size": self.size
         }
 
+        if self.placeholder is not None:
+            data["placeholder"] = self.placeholder
+
         if self.parent is not None:
-            data["parent"] = self.parent.to_json
+            # The thumbnail has a placeholder of its own
+            parent = self.parent.to_json
+            parent.pop("placeholder", None)
+            data["parent"] = parent
 
         return data
 
@@ -74,8 +163,10 @@ class ImageAsset(models.Model):
         try:
             return ImageAsset.objects.get(parent_id=self.id, **requested)
         except ImageAsset.DoesNotExist:
+            storage = get_storage()
+
             im = Image.open(
-                requests.get(self.url, stream=True).raw
+                storage.open(self.key, self.bucket)
             )
 
             im.thumbnail(thumb_size, Image.BICUBIC)
@@ -86,23 +177,16 @@ class ImageAsset(models.Model):
                 size = fh.tell()
                 fh.seek(0, io.SEEK_SET)
 
-                s3 = boto3.client("s3", **settings.ASSETS["config"])
-
-                key = settings.ASSETS["prefix"] + "images/" + str(uuid.uuid4()) + ".png"
-                bucket = settings.ASSETS["bucket"]
-
-                s3.upload_fileobj(fh, bucket, key, ExtraArgs={
-                    "ContentType": "image/png",
-                    "ACL": "public-read",
-                    "CacheControl": "public, max-age=2592000"
-                })
+                key = storage.new_image_key(".png")
+                storage.upload(fh, key, content_type="image/png")
 
                 thumb = ImageAsset(
-                    bucket=bucket,
+                    bucket=storage.bucket,
                     key=key,
                     size=size,
                     width=im.width,
                     height=im.height,
+                    placeholder=create_placeholder(im),
                     parent_id=self.id,
                     **requested
                 )
@@ -112,54 +196,161 @@ class ImageAsset(models.Model):
                 return thumb
 
     def delete(self, *args, **kwargs):
-        s3 = boto3.client("s3", **settings.ASSETS["config"])
-
-        s3.delete_object(
-            Bucket=self.bucket,
-            Key=self.key
+        # Shared assets only lose a reference
+        if ImageAsset.objects.filter(id=self.id, ref_count__gt=1).update(ref_count=F("ref_count") - 1):
+            self.ref_count -= 1
+            return 0, {}
+
+        # Thumbnails are removed by the database cascade, so their objects
+        # have to be collected before the rows go away
+        ImageAsset._delete_objects(
+            [(self.bucket, self.key)] + list(ImageAsset.objects.filter(parent_id=self.id).values_list("bucket", "key"))
         )
 
         return super(ImageAsset, self).delete(*args, **kwargs)
 
+    @classmethod
+    def delete_many(cls, assets: List['ImageAsset']):
+        """
+        Delete several assets (and their thumbnails) with as few S3 requests as possible
+        """
+        asset_ids = [asset.id for asset in assets]
+
+        # Shared assets only lose a reference
+        shared = cls.objects.filter(id__in=asset_ids, ref_count__gt=1)
+        shared_ids = set(shared.values_list("id", flat=True))
+        cls.objects.filter(id__in=shared_ids).update(ref_count=F("ref_count") - 1)
+
+        asset_ids = [asset_id for asset_id in asset_ids if asset_id not in shared_ids]
+
+        if not asset_ids:
+            return
+
+        cls._delete_objects(list(cls.objects.filter(
+            Q(id__in=asset_ids) | Q(parent_id__in=asset_ids)
+        ).values_list("bucket", "key")))
+
+        cls.objects.filter(id__in=asset_ids).delete()
+
     @staticmethod
-    def upload_file(image, old_asset: Optional['ImageAsset']) -> 'ImageAsset':
-        s3 = boto3.client("s3", **settings.ASSETS["config"])
+    def _delete_objects(objects: List[Tuple[str, str]]):
+        # One batched delete per bucket the (bucket, key) objects are in
+        keys_by_bucket = {}  # type: Dict[str, List[str]]
 
-        if old_asset is not None:
-            old_asset.delete()
+        for bucket, key in objects:
+            keys_by_bucket.setdefault(bucket, []).append(key)
 
-        _, ext = path.splitext(image.name)
-        key = settings.ASSETS["prefix"] + "images/" + str(uuid.uuid4()) + ext
-        bucket = settings.ASSETS["bucket"]
+        storage = get_storage()
 
-        width, height = image.image.size
+        for bucket, keys in keys_by_bucket.items():
+            storage.delete(keys, bucket)
 
-        s3.upload_fileobj(image.file, bucket, key, ExtraArgs={
-            "ContentType": image.content_type,
-            "ACL": "public-read",
-            "CacheControl": "public, max-age=2592000"
-        })
+    @classmethod
+    def find_duplicate(cls, digest: str, phash: str, perceptual: bool = True) -> Optional['ImageAsset']:
+        """
+        Find an original with the exact same content, or, when perceptual and
+        ASSETS["perceptual_threshold"] is configured, one whose perceptual hash is within
+        the threshold.
 
-        asset = ImageAsset(
-            bucket=bucket,
-            key=key,
-            size=image.size,
-            width=width,
-            height=height
-        )
+        A hash within the threshold t differs in at most t hex digits, so split in t + 1
+        parts one of them is equal to the same part of phash. Only the originals sharing
+        a part are loaded, but the database still compares the parts of every original
+        (a scan of the perceptual hashes, like the one of the content hashes would be
+        without its index).
+        """
+        originals = cls.objects.filter(parent_id__isnull=True, bucket=get_storage().bucket)
+
+        duplicate = originals.filter(content_hash=digest).first()
+        if duplicate is not None:
+            return duplicate
+
+        threshold = settings.ASSETS.get("perceptual_threshold")
+        if not perceptual or threshold is None:
+            return None
+
+        best_id, best_distance = None, threshold + 1
+
+        candidates = originals.filter(perceptual_hash__isnull=False)
+
+        if threshold < len(phash):
+            parts = _hash_parts(phash, threshold + 1)
+
+            candidates = candidates \
+                .alias(**{
+                    f"part_{i}": Substr("perceptual_hash", start + 1, len(part))
+                    for i, (start, part) in enumerate(parts)
+                }) \
+                .filter(functools.reduce(operator.or_, [
+                    Q(**{f"part_{i}": part})
+                    for i, (_, part) in enumerate(parts)
+                ]))
+
+        for asset_id, other in candidates.values_list("id", "perceptual_hash").iterator():
+            distance = hamming_distance(phash, other)
 
-        asset.save()
+            if distance < best_distance:
+                best_id, best_distance = asset_id, distance
+
+        if best_id is None:
+            return None
+
+        return cls.objects.get(id=best_id)
+
+    @staticmethod
+    def upload_file(image, old_asset: Optional['ImageAsset'], perceptual: bool = True) -> 'ImageAsset':
+        """
+        Store the image, or reuse an identical original. Similar originals are only
+        reused when perceptual, uploads of users must keep their own picture.
+        """
+        digest = file_digest(image.file)
+
+        # The image attached by the form was only verified, so it has to be opened again to read the pixels
+        im = Image.open(image.file)
+        phash = difference_hash(im)
+
+        asset = ImageAsset.find_duplicate(digest, phash, perceptual)
+
+        if asset is not None:
+            log.info("reusing image asset %s for %s", asset.id, image.name)
+
+            ImageAsset.objects.filter(id=asset.id).update(ref_count=F("ref_count") + 1)
+            asset.refresh_from_db(fields=["ref_count"])
+        else:
+            placeholder = create_placeholder(im)
+            image.file.seek(0)
+
+            storage = get_storage()
+
+            _, ext = path.splitext(image.name)
+            key = storage.new_image_key(ext)
+
+            width, height = image.image.size
+
+            storage.upload(image.file, key, content_type=image.content_type)
+
+            asset = ImageAsset(
+                bucket=storage.bucket,
+                key=key,
+                size=image.size,
+                width=width,
+                height=height,
+                placeholder=placeholder,
+                content_hash=digest,
+                perceptual_hash=phash
+            )
+
+            asset.save()
+
+        # Release the old asset only after the new one is in place, the upload might be
+        # a reference to the very same asset
+        if old_asset is not None:
+            old_asset.delete()
 
         return asset
 
     @property
     def url(self):
-        cdn = settings.ASSETS.get("cdn")
-
-        if cdn is not None:
-            return f"https://{cdn}/{self.key}"
-        else:
-            return f"https://{self.bucket}.s3.amazonaws.com/{self.key}"
+        return get_storage().url(self.key, self.bucket)
 
     @classmethod
     def resolve_thumbs(cls, image_ids: Set[int], thumb_size: int) -> Dict[int, "ImageAsset"]:
@@ -197,6 +388,71 @@ class ImageAsset(models.Model):
         return images
 
 
+def _identity(value):
+    return value
+
+
+def _resolve(instance, column: str):
+    # Follow a values() style lookup like region__name on a model instance
+    value = instance
+    for part in column.split("__"):
+        if value is None:
+            return None
+        value = getattr(value, part)
+
+    return value
+
+
+@dataclasses.dataclass(frozen=True)
+class ShortField:
+    """
+    A key of the short json document, built from the values of columns (values() style
+    lookups), so a subset of the keys can be produced from a subset of the columns
+    """
+    name: str
+    columns: Tuple[str, ...]
+    build: Callable[..., Any] = _identity
+
+    @property
+    def related(self) -> Set[str]:
+        return {column.split("__")[0] for column in self.columns if "__" in column}
+
+    def from_instance(self, instance) -> Any:
+        return self.build(*[_resolve(instance, column) for column in self.columns])
+
+
+@dataclasses.dataclass(frozen=True)
+class ShortRow:
+    """
+    Short json document built by Attraction.short_values, with the columns
+    the caller needs besides the document
+    """
+    main_image_id: Optional[int]
+    document: dict
+    extra: tuple
+
+
+def _filter_json(filter_id: Optional[int], name: Optional[str]) -> Optional[dict]:
+    if filter_id is None:
+        return None
+
+    return {
+        "id": filter_id,
+        "name": name
+    }
+
+
+def filter_field(name: str) -> ShortField:
+    """
+    Short field for a foreign key to an AttractionFilter, serialized like AttractionFilter.to_json
+    """
+    return ShortField(name, (name + "_id", name + "__name"), _filter_json)
+
+
+def _type_string(content_type_id: int) -> str:
+    return ContentType.objects.get_for_id(content_type_id).model_class().api_single_key()
+
+
 class AttractionFilter(models.Model):
     name = models.CharField(max_length=200)
     date_modified = models.DateTimeField(auto_now=True)
@@ -218,6 +474,10 @@ class AttractionFilter(models.Model):
     class Meta:
         abstract = True
         ordering = ["name"]
+        indexes = [
+            # latest() of the conditional filter requests
+            models.Index(fields=['date_modified']),
+        ]
 
 
 class Region(AttractionFilter):
@@ -276,6 +536,8 @@ class Attraction(models.Model):
 
     lat = models.FloatField()
     long = models.FloatField()
+    # Maintained by save, range lookups over a prefix find the attractions in a cell
+    geohash = models.CharField(max_length=geohash.PRECISION, editable=False, db_index=True, default="")
 
     date_modified = models.DateTimeField(auto_now=True)
 
@@ -290,11 +552,50 @@ class Attraction(models.Model):
     avg_rating = models.DecimalField(max_digits=2, decimal_places=1, default=0)
     rating_count = models.PositiveIntegerField(default=0)
 
+    # Weighted search_texts, maintained by save on PostgreSQL (see attractions2.search)
+    search_vector = SearchVectorField(null=True, editable=False)
+
     def save(self, *args, **kwargs):
         if self.content_type is None:
             self.content_type = ContentType.objects.get_for_model(self.__class__)
+        self.geohash = geohash.encode(self.lat, self.long)
         super(Attraction, self).save(*args, **kwargs)
 
+        # The generic model (saved to update the rating) doesn't have the texts of the category
+        if type(self) is not Attraction:
+            self.update_search_vector()
+
+    def search_texts(self) -> List[Tuple[Optional[str], str]]:
+        """
+        The searchable texts with their weight, A ranks highest
+        """
+        return [(self.name, "A")]
+
+    def update_search_vector(self):
+        if connection.vendor != "postgresql":
+            return
+
+        vectors = [
+            SearchVector(Value(text or "", output_field=models.TextField()), weight=weight, config=SEARCH_CONFIG)
+            for text, weight in self.search_texts()
+        ]
+
+        Attraction.objects.filter(pk=self.pk).update(search_vector=functools.reduce(operator.add, vectors))
+
+    def add_additional_image(self, image) -> ImageAsset:
+        """
+        Upload an additional image, the reference of an identical image which is already
+        attached is released since the relation holds it once
+        """
+        asset = ImageAsset.upload_file(image, old_asset=None)
+
+        if self.additional_images.filter(pk=asset.pk).exists():
+            asset.delete()
+        else:
+            self.additional_images.add(asset)
+
+        return asset
+
     @classmethod
     def short_related(cls) -> List[str]:
         raise NotImplementedError("short_related not implemented")
@@ -304,17 +605,100 @@ class Attraction(models.Model):
         return cls.objects \
             .select_related(*cls.short_related())
 
+    @classmethod
+    def detail_related(cls) -> List[str]:
+        """
+        The foreign keys to_json follows, joined by detail_query
+        """
+        return cls.short_related()
+
+    @classmethod
+    def detail_prefetch(cls) -> List[str]:
+        """
+        The many to many fields to_json (or get_single) reads, prefetched by detail_query
+        """
+        return ["additional_images"]
+
+    @classmethod
+    def detail_query(cls):
+        """
+        The query loading everything needed for the detail document, one query plus
+        one per prefetched relation
+        """
+        return cls.objects \
+            .select_related(*cls.detail_related()) \
+            .prefetch_related(*cls.detail_prefetch())
+
+    @classmethod
+    def facet_fields(cls) -> Dict[str, str]:
+        """
+        The explore facets, the facet name and the values() lookup counted for it
+        """
+        return {
+            related: related + "_id"
+            for related in cls.short_related()
+        }
+
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return [
+            ShortField("id", ("id",)),
+            ShortField("name", ("name",)),
+            ShortField("lat", ("lat",)),
+            ShortField("long", ("long",)),
+            # Generic attractions are typed by their content type
+            ShortField("type", ("content_type_id",), _type_string),
+            # Transfer the rating as a string to avoid rounding errors
+            ShortField("avg_rating", ("avg_rating",), str),
+            ShortField("rating_count", ("rating_count",)),
+        ]
+
+    @classmethod
+    def short_values(cls, query_set, fields: Optional[Set[str]] = None, extra: Tuple[str, ...] = ()) -> List[ShortRow]:
+        """
+        Build the short json documents straight from a values_list() query over exactly the
+        columns (and joins) the fields need, without instantiating the models.
+
+        fields restricts the keys like short_json, extra columns (like a keyset sort field)
+        are returned next to the documents.
+        """
+        columns = ["main_image_id", *extra]
+        builders = []
+
+        for field in cls.short_fields():
+            if fields is None or field.name in fields or field.name == "id":
+                start = len(columns)
+                columns.extend(field.columns)
+                builders.append((field.name, field.build, start, len(columns)))
+
+        extra_end = 1 + len(extra)
+
+        return [
+            ShortRow(
+                main_image_id=row[0],
+                document={
+                    name: build(*row[start:end])
+                    for name, build, start, end in builders
+                },
+                extra=row[1:extra_end]
+            )
+            for row in query_set.values_list(*columns)
+        ]
+
     @classmethod
     def favorite(cls, user_id: uuid.UUID):
+        # The annotation reuses the join of the filter, so it can be used as a keyset sort field
         return cls.short_query() \
             .filter(favorite__user_id=user_id) \
-            .order_by("-favorite__created")
+            .annotate(favorite_created=F("favorite__created")) \
+            .order_by("-favorite_created", "-id")
 
     @classmethod
     def history(cls, user_id: uuid.UUID):
         return cls.short_query() \
             .filter(history__user_id=user_id) \
-            .order_by("-history__last_visited")
+            .annotate(last_visited=F("history__last_visited")) \
+            .order_by("-last_visited", "-id")
 
     @classmethod
     def api_multiple_key(cls) -> str:
@@ -328,25 +712,20 @@ class Attraction(models.Model):
     def explore_filter(cls, query_set, request):
         raise NotImplementedError("explore_filter not implemented")
 
-    @property
-    def to_short_json(self):
-        try:
-            type_string = self.api_single_key()
-        except NotImplementedError:
-            # For generic attraction write type string based on the content type
-            type_string = self.content_type.model_class().api_single_key()
-
+    def short_json(self, fields: Optional[Set[str]] = None) -> dict:
+        """
+        The short json document, restricted to fields if given (the id is always included)
+        """
         return {
-            "id": self.id,
-            "name": self.name,
-            "lat": self.lat,
-            "long": self.long,
-            "type": type_string,
-            # Transfer the rating as a string to avoid rounding errors
-            "avg_rating": str(self.avg_rating),
-            "rating_count": self.rating_count
+            field.name: field.from_instance(self)
+            for field in self.short_fields()
+            if fields is None or field.name in fields or field.name == "id"
         }
 
+    @property
+    def to_short_json(self):
+        return self.short_json()
+
     @property
     def to_json(self):
         raise NotImplementedError("to_json not implemented")
@@ -354,6 +733,15 @@ class Attraction(models.Model):
     def __str__(self):
         return self.name
 
+    class Meta:
+        indexes = [
+            # Explore ordering and its keyset pagination
+            models.Index(fields=['name', 'id']),
+            # Bounding box of the map
+            models.Index(fields=['lat', 'long']),
+            models.Index(fields=['date_modified']),
+        ]
+
 
 class ManagedAttraction(Attraction):
     description = models.TextField(blank=True, null=True)
@@ -370,6 +758,13 @@ class ManagedAttraction(Attraction):
     def short_related(cls) -> List[str]:
         return ["region"]
 
+    def search_texts(self) -> List[Tuple[Optional[str], str]]:
+        return super().search_texts() + [
+            (self.city, "B"),
+            (self.address, "B"),
+            (self.description, "C"),
+        ]
+
     @classmethod
     def explore_filter(cls, query_set, request):
         # https://hollyland.iywebs.cloudns.ph/attractions/api/museums?region_id=4&region_id=2
@@ -393,18 +788,14 @@ class ManagedAttraction(Attraction):
             .defer("description", "website") \
             .select_related(*cls.short_related())
 
-    @property
-    def to_short_json(self):
-        data = super(ManagedAttraction, self).to_short_json
-
-        data.update({
-            "region": self.region.to_json,
-            "address": self.address,
-            "city": self.city,
-            "telephone": self.telephone,
-        })
-
-        return data
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            filter_field("region"),
+            ShortField("address", ("address",)),
+            ShortField("city", ("city",)),
+            ShortField("telephone", ("telephone",)),
+        ]
 
     @property
     def to_json(self):
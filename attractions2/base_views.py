@@ -109,17 +109,15 @@ class EditView(View, abc.ABC):
             instance.save()
 
             if form.cleaned_data["additional_image"]:
-                instance.additional_images.add(models.ImageAsset.upload_file(
-                    form.cleaned_data["additional_image"],
-                    old_asset=None
-                ))
+                instance.add_additional_image(form.cleaned_data["additional_image"])
 
             # Delete any additional image chosen for delete
-            for additional_id in request.POST.getlist("delete_additional"):
-                additional = instance.additional_images.get(pk=int(additional_id))
-                instance.additional_images.remove(additional)
+            delete_ids = list(map(int, request.POST.getlist("delete_additional")))
+            if delete_ids:
+                removed = list(instance.additional_images.filter(pk__in=delete_ids))
+                instance.additional_images.remove(*removed)
 
-                additional.delete()
+                models.ImageAsset.delete_many(removed)
 
             self.handle_m2m(instance, form.cleaned_data)
 
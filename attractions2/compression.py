@@ -0,0 +1,66 @@
+import gzip
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this don't gain enough to be worth compressing
+MIN_SIZE = 200
+
+# Only the API responses: pages carrying a CSRF token (admin, back office) would be
+# open to BREACH once compressed
+COMPRESSIBLE_TYPES = ("application/json",)
+
+
+def _accepted(accept_encoding: str) -> dict:
+    accepted = {}
+
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+
+        if coding:
+            accepted[coding.strip().lower()] = quality
+
+    return accepted
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """
+    Pick the content coding for the Accept-Encoding header, brotli is preferred when
+    installed, None means the body should be sent as is
+    """
+    accepted = _accepted(accept_encoding)
+    wildcard = accepted.get("*", 0.0)
+
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+
+        if accepted.get(coding, wildcard) > 0:
+            return coding
+
+    return None
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(body)
+    elif coding == "gzip":
+        # Fixed mtime so the same body always compresses to the same bytes
+        return gzip.compress(body, mtime=0)
+    else:
+        raise ValueError(f"unsupported content coding: {coding}")
+
+
+def is_compressible(content_type: str, size: int) -> bool:
+    return size >= MIN_SIZE and content_type.startswith(COMPRESSIBLE_TYPES)
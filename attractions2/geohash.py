@@ -0,0 +1,121 @@
+import math
+from typing import List, Tuple
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Precision stored in Attraction.geohash, cells of about 4.8m x 4.8m
+PRECISION = 9
+
+EARTH_RADIUS = 6370 * 1000  # In meters, same as the trail analysis
+
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def encode(lat: float, long: float, precision: int = PRECISION) -> str:
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(chars) < precision:
+        # Even bits split the longitude, odd bits the latitude
+        current_range, current = (long_range, long) if even else (lat_range, lat)
+        middle = (current_range[0] + current_range[1]) / 2
+
+        value <<= 1
+        if current >= middle:
+            value |= 1
+            current_range[0] = middle
+        else:
+            current_range[1] = middle
+
+        even = not even
+        bits += 1
+
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return "".join(chars)
+
+
+def prefix_end(cell: str) -> str:
+    """
+    The upper bound (exclusive) of the geohashes starting with cell, a range lookup
+    uses a plain B-tree index on every database unlike LIKE 'cell%'
+    """
+    return cell + chr(ord(BASE32[-1]) + 1)
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """
+    The (height, width) of a cell in degrees
+    """
+    long_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+
+    return 180 / 2 ** lat_bits, 360 / 2 ** long_bits
+
+
+def cell_span(lat: float, precision: int) -> float:
+    """
+    The smallest dimension in meters of a cell at the latitude
+    """
+    height, width = cell_size(precision)
+
+    return min(height, width * math.cos(math.radians(lat))) * METERS_PER_DEGREE
+
+
+def precision_for(radius: float, lat: float) -> int:
+    """
+    The finest precision whose cells are at least radius meters wide, so a cell and
+    its neighbours cover every point within radius of the center
+    """
+    for precision in range(PRECISION, 0, -1):
+        if cell_span(lat, precision) >= radius:
+            return precision
+
+    return 0
+
+
+def neighbours(lat: float, long: float, precision: int) -> List[str]:
+    """
+    The cell of the point and the 8 cells around it
+    """
+    height, width = cell_size(precision)
+    cells = []
+
+    for d_lat in (-height, 0, height):
+        for d_long in (-width, 0, width):
+            neighbour_lat = lat + d_lat
+            neighbour_long = long + d_long
+
+            if not -90 <= neighbour_lat <= 90:
+                continue
+
+            # Wrap around the antimeridian
+            neighbour_long = (neighbour_long + 180) % 360 - 180
+
+            cell = encode(neighbour_lat, neighbour_long, precision)
+            if cell not in cells:
+                cells.append(cell)
+
+    return cells
+
+
+def distance(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    """
+    Haversine distance in meters
+    """
+    lat1 = math.radians(lat1)
+    long1 = math.radians(long1)
+    lat2 = math.radians(lat2)
+    long2 = math.radians(long2)
+
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * math.atan2(math.sqrt(a), math.sqrt(1 - a))
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import jwt
+import requests
+
+log = logging.getLogger(__name__)
+
+CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+
+# Used when the response doesn't have a max-age
+DEFAULT_MAX_AGE = 60 * 60
+
+# The keys are refreshed in the background once this share of their max-age passed
+REFRESH_AFTER = 0.8
+
+# An unknown kid refetches the keys at most this often (in seconds), tokens with made up
+# kids shouldn't send every login to Google
+MIN_REFETCH_INTERVAL = 60
+
+FETCH_TIMEOUT = 10
+
+
+def parse_max_age(cache_control: Optional[str]) -> Optional[int]:
+    """
+    The max-age of a Cache-Control header, None when it's missing or no-cache/no-store
+    """
+    if not cache_control:
+        return None
+
+    max_age = None
+
+    for directive in cache_control.split(","):
+        name, _, value = directive.partition("=")
+        name = name.strip().lower()
+
+        if name in ("no-cache", "no-store"):
+            return None
+        elif name == "max-age":
+            try:
+                max_age = int(value.strip().strip('"'))
+            except ValueError:
+                pass
+
+    return max_age
+
+
+class GoogleKeys:
+    """
+    Process wide cache of the keys Google signs ID tokens with. The keys are kept for the
+    max-age of the response, refreshed in the background before they expire and
+    refetched early only for a kid that isn't known yet (Google rotated the keys).
+    """
+
+    def __init__(self, url: str = CERTS_URL):
+        self.url = url
+        self.keys = {}  # type: Dict[str, jwt.PyJWK]
+        self.fetched = 0.0
+        self.refresh_at = 0.0
+        self.expires = 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def fetch(self):
+        response = requests.get(self.url, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+
+        keys = {
+            key.key_id: key
+            for key in jwt.PyJWKSet.from_dict(response.json()).keys
+            if key.key_id is not None
+        }
+
+        max_age = parse_max_age(response.headers.get("Cache-Control"))
+        if max_age is None:
+            max_age = DEFAULT_MAX_AGE
+
+        now = time.monotonic()
+
+        # Swapped in at once, readers without the lock see either the old or the new keys
+        self.keys = keys
+        self.fetched = now
+        self.refresh_at = now + max_age * REFRESH_AFTER
+        self.expires = now + max_age
+
+    def _refresh_in_background(self):
+        try:
+            self.fetch()
+        except (requests.RequestException, ValueError, jwt.PyJWTError):
+            # The current keys are still valid until they expire, the next login retries
+            log.exception("Refreshing the Google signing keys failed")
+        finally:
+            self.refreshing = False
+
+    def get_signing_key(self, kid: str) -> jwt.PyJWK:
+        now = time.monotonic()
+
+        if now >= self.expires:
+            with self.lock:
+                if time.monotonic() >= self.expires:
+                    self.fetch()
+        elif now >= self.refresh_at and not self.refreshing:
+            with self.lock:
+                if not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+        if kid not in self.keys:
+            with self.lock:
+                if kid not in self.keys and time.monotonic() - self.fetched >= MIN_REFETCH_INTERVAL:
+                    self.fetch()
+
+        try:
+            return self.keys[kid]
+        except KeyError:
+            raise jwt.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+
+    def get_signing_key_from_jwt(self, token: str) -> jwt.PyJWK:
+        return self.get_signing_key(jwt.get_unverified_header(token).get("kid"))
+
+
+_keys = GoogleKeys()
+
+
+def get_keys() -> GoogleKeys:
+    return _keys
@@ -0,0 +1,137 @@
+import base64
+import binascii
+import dataclasses
+import json
+from datetime import datetime
+from typing import Any, Callable, List, Optional
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Q
+
+# Upper bound for the limit parameter of the list endpoints
+MAX_LIMIT = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class InvalidLimit(ValueError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class KeysetPage:
+    items: List[Any]
+    next_cursor: Optional[str]
+
+
+def encode_cursor(values: List[Any]) -> str:
+    # isoformat keeps the microseconds, which DjangoJSONEncoder would truncate
+    data = json.dumps([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values
+    ]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(f"Malformed cursor: {cursor}")
+
+    if not isinstance(values, list) or len(values) != 2 or not _is_number(values[1], int):
+        raise InvalidCursor(f"Malformed cursor: {cursor}")
+
+    return values
+
+
+def _is_number(value, types=(int, float)) -> bool:
+    # bool is an int too
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def _sort_value(query_set, sort_field: str, value, cursor: str):
+    """
+    The sort value of the cursor as the type of the sort field (or annotation), a value
+    of another type would fail in the database or silently match nothing
+    """
+    if sort_field in query_set.query.annotations:
+        field = query_set.query.annotations[sort_field].output_field
+    else:
+        field = query_set.model._meta.get_field(sort_field)
+
+    if isinstance(field, (models.IntegerField, models.FloatField, models.DecimalField)):
+        valid = _is_number(value)
+    else:
+        # Strings, and the datetimes encode_cursor writes in ISO format
+        valid = isinstance(value, str)
+
+    try:
+        if valid:
+            return field.to_python(value)
+    except (ValidationError, TypeError, ValueError):
+        pass
+
+    raise InvalidCursor(f"Malformed cursor: {cursor}")
+
+
+def parse_limit(value) -> Optional[int]:
+    if value is None or value == "":
+        return None
+
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise InvalidLimit(f"Invalid limit: {value}")
+
+    if limit < 1:
+        raise InvalidLimit(f"Invalid limit: {value}")
+
+    return min(limit, MAX_LIMIT)
+
+
+def _instance_position(sort_field: str) -> Callable[[Any], List[Any]]:
+    return lambda row: [getattr(row, sort_field), row.id]
+
+
+def paginate(query_set, sort_field: str, descending: bool, cursor: Optional[str], limit: int,
+             fetch: Callable[[Any], List[Any]] = list,
+             position: Optional[Callable[[Any], List[Any]]] = None) -> KeysetPage:
+    """
+    Return up to limit rows ordered by (sort_field, id) that come after the row encoded in
+    the cursor. Unlike an OFFSET, the position is stable while rows are being inserted.
+
+    sort_field can be a field or an annotation of the query set, the id is used to break ties.
+    fetch turns the sliced query set into rows (model instances by default) and position
+    returns the [sort value, id] of a row.
+    """
+    if position is None:
+        position = _instance_position(sort_field)
+
+    direction = "-" if descending else ""
+    comparison = "lt" if descending else "gt"
+
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor)
+        sort_value = _sort_value(query_set, sort_field, sort_value, cursor)
+
+        # The first condition is implied by the second, it lets the database seek in an
+        # index on (sort_field, id) instead of scanning it for the OR
+        query_set = query_set.filter(
+            Q(**{f"{sort_field}__{comparison}e": sort_value}),
+            Q(**{f"{sort_field}__{comparison}": sort_value}) |
+            Q(**{sort_field: sort_value, f"id__{comparison}": last_id})
+        )
+
+    rows = fetch(query_set.order_by(direction + sort_field, direction + "id")[:limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(position(rows[-1]))
+
+    return KeysetPage(items=rows, next_cursor=next_cursor)
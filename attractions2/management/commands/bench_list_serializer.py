@@ -0,0 +1,71 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from attractions2 import models
+from attractions2.base_models import Region
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Compare the instance based and the values() based short json serialization (the data is rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000, help="Number of museums to seed")
+        parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs of each path")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.seed(options["rows"])
+
+                instances = self.measure(
+                    options["repeat"],
+                    lambda: [museum.short_json() for museum in models.Museum.short_query()]
+                )
+
+                values = self.measure(
+                    options["repeat"],
+                    lambda: [row.document for row in models.Museum.short_values(models.Museum.short_query())]
+                )
+
+                self.stdout.write(f"instances: {instances:,.0f} rows/s")
+                self.stdout.write(f"values:    {values:,.0f} rows/s ({values / instances:.1f}x)")
+
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, rows: int):
+        regions = [Region.objects.create(name=f"Bench region {i}") for i in range(10)]
+        domains = [models.MuseumDomain.objects.create(name=f"Bench domain {i}") for i in range(10)]
+
+        # Multi table inheritance can't be bulk created, create the rows one by one
+        for i in range(rows):
+            models.Museum.objects.create(
+                name=f"Bench museum {i}",
+                lat=31 + (i % 300) / 100,
+                long=34.5 + (i % 150) / 100,
+                address=f"Street {i}",
+                region=regions[i % len(regions)],
+                domain=domains[i % len(domains)],
+            )
+
+    @staticmethod
+    def measure(repeat: int, serialize) -> float:
+        best = None
+        count = 0
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            count = len(serialize())
+            elapsed = time.perf_counter() - start
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return count / best
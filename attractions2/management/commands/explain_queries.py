@@ -0,0 +1,148 @@
+import random
+import re
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from attractions2 import geohash, keyset, models
+from attractions2.base_models import Region
+
+# A scan over one of these tables means an index is missing, the filter tables are small enough to scan
+SCAN_PATTERNS = [
+    re.compile(r"Seq Scan on (\w+)"),  # PostgreSQL
+    re.compile(r"\bSCAN (?:TABLE )?(\w+)(?:\s+AS\s+\w+)?\s*$"),  # SQLite, a SCAN without USING INDEX
+]
+
+
+def keyset_page(query_set):
+    """
+    The query keyset.paginate runs for the second page
+    """
+    captured = []
+
+    def fetch(sliced):
+        captured.append(sliced)
+        return []
+
+    keyset.paginate(query_set, "name", False, keyset.encode_cursor(["Explain museum 5", 5]), 50, fetch=fetch)
+
+    return captured[0]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Run EXPLAIN on the canonical query of each endpoint over seeded data (rolled back), " \
+           "fails when a sequential scan of an attraction table shows up"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000, help="Number of attractions to seed")
+        parser.add_argument("--verbose-plans", action="store_true", help="Print the plan of every query")
+
+    def handle(self, *args, **options):
+        failures = []
+
+        try:
+            with transaction.atomic():
+                self.seed(options["rows"])
+
+                if connection.vendor == "postgresql":
+                    with connection.cursor() as cursor:
+                        cursor.execute("ANALYZE")
+
+                large_tables = {
+                    model._meta.db_table
+                    for model in [models.Attraction, *models.get_attraction_classes()]
+                }
+
+                for name, query_set in self.queries():
+                    plan = query_set.explain()
+
+                    if options["verbose_plans"]:
+                        self.stdout.write(f"{name}:\n{plan}\n")
+
+                    scanned = sorted(self.scanned_tables(plan) & large_tables)
+                    if scanned:
+                        failures.append(name)
+                        self.stdout.write(self.style.ERROR(f"{name}: sequential scan of {', '.join(scanned)}"))
+                        self.stdout.write(plan)
+                    else:
+                        self.stdout.write(self.style.SUCCESS(f"{name}: ok"))
+
+                raise Rollback()
+        except Rollback:
+            pass
+
+        if failures:
+            raise CommandError(f"{len(failures)} queries scan an attraction table: {', '.join(failures)}")
+
+    @staticmethod
+    def scanned_tables(plan: str) -> set:
+        tables = set()
+
+        for line in plan.splitlines():
+            for pattern in SCAN_PATTERNS:
+                match = pattern.search(line)
+                if match:
+                    tables.add(match.group(1))
+
+        return tables
+
+    def seed(self, rows: int):
+        random.seed(rows)
+
+        regions = [Region.objects.create(name=f"Explain region {i}") for i in range(10)]
+        domains = [models.MuseumDomain.objects.create(name=f"Explain domain {i}") for i in range(10)]
+        owner = models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+
+        # Multi table inheritance can't be bulk created, create the rows one by one
+        for i in range(rows):
+            lat = random.uniform(29.5, 33.3)
+            long = random.uniform(34.2, 35.9)
+
+            if i % 2:
+                models.Museum.objects.create(
+                    name=f"Explain museum {i}",
+                    lat=lat,
+                    long=long,
+                    address=f"Street {i}",
+                    region=regions[i % len(regions)],
+                    domain=domains[i % len(domains)],
+                )
+            else:
+                models.Trail.objects.create(
+                    name=f"Explain trail {i}",
+                    lat=lat,
+                    long=long,
+                    difficulty=random.choice("ENH"),
+                    length=random.randint(500, 30000),
+                    elv_gain=random.randint(0, 1500),
+                    owner=owner,
+                )
+
+    @staticmethod
+    def queries():
+        user_id = uuid.uuid4()
+        cell = geohash.encode(31.77, 35.21, 5)
+
+        yield "explore", models.Museum.short_query().order_by("name", "id")[:50]
+        yield "explore next page", keyset_page(models.Museum.short_query().order_by("name", "id"))
+        yield "explore trails by length", models.Trail.short_query().filter(
+            length__gte=25000, length__lte=26000
+        ).order_by("name", "id")
+        yield "explore trails by elevation gain", models.Trail.short_query().filter(
+            elv_gain__gte=1400
+        ).order_by("name", "id")
+        yield "explore trails by difficulty and length", models.Trail.short_query().filter(
+            difficulty="H", length__gte=29000
+        ).order_by("name", "id")
+        yield "map", models.Attraction.objects.filter(
+            lat__gte=31.7, lat__lte=31.8, long__gte=35.1, long__lte=35.3
+        )
+        yield "nearby", models.Attraction.objects.filter(geohash__gte=cell, geohash__lt=geohash.prefix_end(cell))
+        yield "favorites", models.Museum.favorite(user_id)[:50]
+        yield "history", models.Museum.history(user_id)[:50]
+        yield "filter last modified", models.MuseumDomain.objects.order_by("-date_modified")[:1]
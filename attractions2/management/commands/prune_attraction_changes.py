@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from attractions2 import models
+from attractions2.spatial_index import REBUILD_INTERVAL
+
+
+class Command(BaseCommand):
+    help = "Delete the attraction change log entries every spatial index has already been rebuilt past"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            default=24,
+            help="Keep the entries of the last hours, must be longer than the index rebuild interval"
+        )
+
+    def handle(self, *args, **options):
+        max_age = timedelta(hours=options["max_age"])
+
+        if max_age.total_seconds() <= REBUILD_INTERVAL:
+            raise CommandError(f"--max-age must be longer than the rebuild interval ({REBUILD_INTERVAL}s)")
+
+        deleted, _ = models.AttractionChange.objects.filter(created__lt=timezone.now() - max_age).delete()
+
+        self.stdout.write(f"deleted {deleted} change log entries")
@@ -0,0 +1,98 @@
+import re
+from datetime import datetime, timedelta
+from typing import Iterator, List, Set
+
+import pytz
+from django.core.management.base import BaseCommand
+
+from attractions2 import models
+from attractions2.storage import DELETE_BATCH_SIZE, get_storage
+
+TRAIL_KEY = re.compile(r"^trails/(\d+)\.csv\.gz$")
+
+
+class Command(BaseCommand):
+    help = "Delete objects under the assets prefix that are no longer referenced by the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the orphaned objects, don't delete anything"
+        )
+
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=24,
+            help="Ignore objects younger than this many hours, uploads write the object before the row"
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options["dry_run"]
+        self.storage = get_storage()
+        self.bucket = self.storage.bucket
+        self.prefix = self.storage.prefix
+        self.pending = []  # type: List[str]
+        self.deleted = 0
+
+        cutoff = datetime.utcnow().replace(tzinfo=pytz.UTC) - timedelta(hours=options["min_age"])
+
+        for page in self.list_pages(cutoff):
+            image_keys = []
+            trail_ids = {}
+
+            for key in page:
+                relative = key[len(self.prefix):]
+
+                if relative.startswith("images/"):
+                    image_keys.append(key)
+                else:
+                    match = TRAIL_KEY.match(relative)
+                    if match:
+                        trail_ids[int(match.group(1))] = key
+
+            known_images = set(models.ImageAsset.objects.filter(
+                bucket=self.bucket,
+                key__in=image_keys
+            ).values_list("key", flat=True))  # type: Set[str]
+
+            known_trails = set(models.Trail.objects.filter(
+                id__in=trail_ids.keys()
+            ).values_list("id", flat=True))  # type: Set[int]
+
+            for key in image_keys:
+                if key not in known_images:
+                    self.queue(key)
+
+            for trail_id, key in trail_ids.items():
+                if trail_id not in known_trails:
+                    self.queue(key)
+
+        self.flush()
+
+        self.stdout.write(f"{self.deleted} orphaned objects {'found' if self.dry_run else 'deleted'}")
+
+    def list_pages(self, cutoff: datetime) -> Iterator[List[str]]:
+        """
+        Stream the keys under the assets prefix one page at a time, so memory use
+        doesn't depend on the size of the bucket
+        """
+        for page in self.storage.list(self.prefix):
+            yield [key for key, modified in page if modified < cutoff]
+
+    def queue(self, key: str):
+        self.stdout.write(f"orphan: {self.storage.url(key)}")
+        self.pending.append(key)
+
+        if len(self.pending) >= DELETE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending and not self.dry_run:
+            failed = self.storage.delete(self.pending)
+            self.deleted += len(self.pending) - len(failed)
+        else:
+            self.deleted += len(self.pending)
+
+        self.pending = []
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0059_auto_20220515_0608'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageasset',
+            name='placeholder',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
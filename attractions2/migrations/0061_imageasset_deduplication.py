@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0060_imageasset_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageasset',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='ref_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:20
+
+from django.db import migrations, models
+
+from attractions2 import geohash
+
+
+def backfill_geohash(apps, schema_editor):
+    Attraction = apps.get_model("attractions2", "Attraction")
+
+    attractions = list(Attraction.objects.only("id", "lat", "long"))
+    for attraction in attractions:
+        attraction.geohash = geohash.encode(attraction.lat, attraction.long)
+
+    Attraction.objects.bulk_update(attractions, ["geohash"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0062_contentversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attraction',
+            name='geohash',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=9),
+        ),
+        migrations.RunPython(backfill_geohash, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0063_attraction_geohash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attraction',
+            index=models.Index(fields=['name', 'id'], name='attractions_name_ed6a12_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attraction',
+            index=models.Index(fields=['lat', 'long'], name='attractions_lat_7c1a06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attraction',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_faf157_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='extremesportstype',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_bd5221_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='museumdomain',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_523873_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='package',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_4a2b12_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='region',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_172393_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rockclimbingtype',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_f8128f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tourdestination',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_831da7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tourlanguage',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_e257cc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trail',
+            index=models.Index(fields=['length'], name='attractions_length_bf60bb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trail',
+            index=models.Index(fields=['elv_gain'], name='attractions_elv_gai_805e06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trail',
+            index=models.Index(fields=['difficulty', 'length'], name='attractions_difficu_ab39d1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='watersportsattractiontype',
+            index=models.Index(fields=['date_modified'], name='attractions_date_mo_aa0e67_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:25
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+TAG_FIELDS = ("activities", "attractions", "suitabilities")
+
+# Same as Trail.MASK_BITS, the historical model doesn't have the methods
+MASK_BITS = 63
+
+
+def backfill_tag_masks(apps, schema_editor):
+    Trail = apps.get_model("attractions2", "Trail")
+
+    masks = defaultdict(lambda: dict.fromkeys(TAG_FIELDS, 0))
+
+    for field in TAG_FIELDS:
+        for trail_id, tag_id in Trail.objects.filter(**{field + "__isnull": False}).values_list("pk", field):
+            if tag_id < MASK_BITS:
+                masks[trail_id][field] |= 1 << tag_id
+
+    trails = []
+    for trail_id, trail_masks in masks.items():
+        trails.append(Trail(pk=trail_id, **{field + "_mask": mask for field, mask in trail_masks.items()}))
+
+    Trail.objects.bulk_update(trails, [field + "_mask" for field in TAG_FIELDS], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0064_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trail',
+            name='activities_mask',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='trail',
+            name='attractions_mask',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='trail',
+            name='suitabilities_mask',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_tag_masks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0065_trail_tag_masks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttractionChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attraction_id', models.BigIntegerField()),
+                ('lat', models.FloatField(null=True)),
+                ('long', models.FloatField(null=True)),
+                ('content_type_id', models.IntegerField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
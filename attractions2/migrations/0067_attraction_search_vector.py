@@ -0,0 +1,76 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:33
+
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Weights of the texts of the category tables, like Attraction.search_texts
+CATEGORY_WEIGHTS = {"city": "B", "address": "B", "description": "C"}
+
+INDEXES = [
+    ("attraction_search_vector_gin", "USING gin (search_vector)"),
+    ("attraction_name_trgm_gin", "USING gin (name gin_trgm_ops)"),
+]
+
+
+def _weighted(column: str, weight: str) -> str:
+    return f"setweight(to_tsvector('simple', coalesce({column}, '')), '{weight}')"
+
+
+def create_search_indexes(apps, schema_editor):
+    # GIN indexes exist only on PostgreSQL, they're kept out of Meta so other
+    # databases can still create the tables
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    quote = schema_editor.quote_name
+    Attraction = apps.get_model("attractions2", "Attraction")
+    table = quote(Attraction._meta.db_table)
+
+    for name, definition in INDEXES:
+        schema_editor.execute(f"CREATE INDEX {quote(name)} ON {table} {definition}")
+
+    schema_editor.execute(f"UPDATE {table} SET search_vector = {_weighted('name', 'A')}")
+
+    for model in apps.get_app_config("attractions2").get_models():
+        if model is Attraction or not issubclass(model, Attraction):
+            continue
+
+        columns = [field for field in CATEGORY_WEIGHTS if any(f.name == field for f in model._meta.local_fields)]
+        if not columns:
+            continue
+
+        vector = " || ".join(
+            [_weighted("a.name", "A")] +
+            [_weighted(f"c.{quote(column)}", CATEGORY_WEIGHTS[column]) for column in columns]
+        )
+
+        schema_editor.execute(
+            f"UPDATE {table} AS a SET search_vector = {vector} "
+            f"FROM {quote(model._meta.db_table)} AS c WHERE c.attraction_ptr_id = a.id"
+        )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    for name, _ in INDEXES:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {schema_editor.quote_name(name)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attractions2', '0066_attractionchange'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='attraction',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
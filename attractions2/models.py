@@ -1,11 +1,15 @@
 import re
-from typing import List, Type, Union, Optional
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple, Type, Union
 
-from django.conf import settings
 from django.db import models
+from django.db.models import F, Q
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from attractions2.base_models import Attraction, AttractionFilter, ImageAsset, GoogleUser, ManagedAttraction
+from attractions2.base_models import Attraction, AttractionFilter, ImageAsset, GoogleUser, ManagedAttraction, \
+    ShortField, filter_field
+from attractions2.storage import get_storage
 
 
 class MuseumDomain(AttractionFilter):
@@ -17,15 +21,11 @@ class MuseumDomain(AttractionFilter):
 class Museum(ManagedAttraction):
     domain = models.ForeignKey(MuseumDomain, on_delete=models.CASCADE)
 
-    @property
-    def to_short_json(self):
-        result = super().to_short_json
-
-        result.update({
-            "domain": self.domain.to_json
-        })
-
-        return result
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            filter_field("domain")
+        ]
 
     @classmethod
     def short_related(cls) -> List[str]:
@@ -97,15 +97,11 @@ class OffRoad(ManagedAttraction):
     def short_related(cls) -> List[str]:
         return super().short_related() + ["trip_type"]
 
-    @property
-    def to_short_json(self):
-        result = super().to_short_json
-
-        result.update({
-            "trip_type": self.trip_type.to_json
-        })
-
-        return result
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            filter_field("trip_type")
+        ]
 
     @classmethod
     def explore_filter(cls, query_set, request):
@@ -141,15 +137,11 @@ class WaterSports(ManagedAttraction):
     def short_related(cls) -> List[str]:
         return super().short_related() + ["attraction_type"]
 
-    @property
-    def to_short_json(self):
-        result = super().to_short_json
-
-        result.update({
-            "attraction_type": self.attraction_type.to_json
-        })
-
-        return result
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            filter_field("attraction_type")
+        ]
 
     @classmethod
     def explore_filter(cls, query_set, request):
@@ -185,15 +177,11 @@ class RockClimbing(ManagedAttraction):
     def short_related(cls) -> List[str]:
         return super().short_related() + ["attraction_type"]
 
-    @property
-    def to_short_json(self):
-        result = super().to_short_json
-
-        result.update({
-            "attraction_type": self.attraction_type.to_json
-        })
-
-        return result
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            filter_field("attraction_type")
+        ]
 
     @classmethod
     def explore_filter(cls, query_set, request):
@@ -229,15 +217,11 @@ class ExtremeSports(ManagedAttraction):
     def short_related(cls) -> List[str]:
         return super().short_related() + ["sport_type"]
 
-    @property
-    def to_short_json(self):
-        result = super().to_short_json
-
-        result.update({
-            "sport_type": self.sport_type.to_json
-        })
-
-        return result
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            filter_field("sport_type")
+        ]
 
     @classmethod
     def explore_filter(cls, query_set, request):
@@ -317,14 +301,15 @@ class Trail(Attraction):
         if "difficulty" in request.GET:
             query_set = query_set.filter(difficulty__in=request.GET.getlist("difficulty"))
 
-        if "activities" in request.GET:
-            query_set = query_set.filter(activities__pk__in=request.GET.getlist("activities"))
-
-        if "attractions" in request.GET:
-            query_set = query_set.filter(attractions__pk__in=request.GET.getlist("attractions"))
-
-        if "suitabilities" in request.GET:
-            query_set = query_set.filter(suitabilities__pk__in=request.GET.getlist("suitabilities"))
+        # Trails with any of the tags, or all of them with activities_match=all
+        for field in cls.TAG_FIELDS:
+            if field in request.GET:
+                query_set = cls._tag_filter(
+                    query_set,
+                    field,
+                    list(map(int, request.GET.getlist(field))),
+                    request.GET.get(field + "_match") == "all"
+                )
 
         # For map
         if "lon_min" in request.GET:
@@ -381,18 +366,106 @@ class Trail(Attraction):
         blank=True
     )
 
-    @property
-    def to_short_json(self):
-        json_result = super(Trail, self).to_short_json
-
-        json_result.update({
-            "difficulty": self.difficulty,
-            "length": self.length,
-            "elevation_gain": self.elv_gain,
-            "owner_id": str(self.owner_id),
-        })
+    # Denormalized tag ids (bit n is set for the tag with id n), kept in sync with the
+    # many to many fields by attractions2.signals so explore filters without joins
+    activities_mask = models.BigIntegerField(default=0, editable=False)
+    attractions_mask = models.BigIntegerField(default=0, editable=False)
+    suitabilities_mask = models.BigIntegerField(default=0, editable=False)
+
+    TAG_FIELDS = ("activities", "attractions", "suitabilities")
+
+    # The masks are signed 64 bit columns, tags with larger ids are matched through the join
+    MASK_BITS = 63
+
+    @classmethod
+    def tag_mask(cls, tag_ids: Iterable[int]) -> Tuple[int, List[int]]:
+        """
+        The mask of the tag ids and the ids which don't fit in it
+        """
+        mask = 0
+        overflow = []
+
+        for tag_id in tag_ids:
+            if 0 <= tag_id < cls.MASK_BITS:
+                mask |= 1 << tag_id
+            else:
+                overflow.append(tag_id)
+
+        return mask, overflow
+
+    @classmethod
+    def sync_tag_masks(cls, trail_ids: Iterable[int]):
+        """
+        Recompute the masks of the trails from the many to many fields
+        """
+        trails = {trail_id: cls(pk=trail_id) for trail_id in trail_ids}
+
+        if not trails:
+            return
+
+        for field in cls.TAG_FIELDS:
+            tags = defaultdict(list)
+
+            for trail_id, tag_id in cls.objects \
+                    .filter(id__in=trails.keys(), **{field + "__isnull": False}) \
+                    .values_list("id", field):
+                tags[trail_id].append(tag_id)
+
+            for trail_id, trail in trails.items():
+                setattr(trail, field + "_mask", cls.tag_mask(tags[trail_id])[0])
+
+        cls.objects.bulk_update(trails.values(), [field + "_mask" for field in cls.TAG_FIELDS])
+
+    @classmethod
+    def _tag_filter(cls, query_set, field: str, tag_ids: List[int], match_all: bool):
+        mask, overflow = cls.tag_mask(tag_ids)
+        masked = F(field + "_mask").bitand(mask)
+
+        if match_all:
+            if mask:
+                query_set = query_set.alias(**{field + "_matched": masked}).filter(**{field + "_matched": mask})
+
+            # A subquery per tag instead of a join, which would duplicate the trails
+            for tag_id in overflow:
+                query_set = query_set.filter(pk__in=cls.objects.filter(**{field: tag_id}).values("pk"))
 
-        return json_result
+            return query_set
+
+        condition = Q()
+        if mask:
+            query_set = query_set.alias(**{field + "_matched": masked})
+            condition |= ~Q(**{field + "_matched": 0})
+
+        if overflow:
+            condition |= Q(pk__in=cls.objects.filter(**{field + "__in": overflow}).values("pk"))
+
+        return query_set.filter(condition)
+
+    @classmethod
+    def detail_related(cls) -> List[str]:
+        return ["owner"]
+
+    @classmethod
+    def detail_prefetch(cls) -> List[str]:
+        return super().detail_prefetch() + list(cls.TAG_FIELDS)
+
+    @classmethod
+    def facet_fields(cls) -> Dict[str, str]:
+        return {
+            "difficulty": "difficulty",
+            "activities": "activities",
+            "attractions": "attractions",
+            "suitabilities": "suitabilities",
+        }
+
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        return super().short_fields() + [
+            ShortField("difficulty", ("difficulty",)),
+            ShortField("length", ("length",)),
+            ShortField("elevation_gain", ("elv_gain",)),
+            ShortField("owner_id", ("owner_id",), str),
+        ]
 
     @property
     def to_json(self):
@@ -415,17 +488,19 @@ class Trail(Attraction):
 
         document["owner"] = self.owner.to_json
 
-        cdn = settings.ASSETS.get("cdn")
-        bucket = settings.ASSETS["bucket"]
-        prefix = settings.ASSETS["prefix"]
-
-        if cdn is not None:
-            document["points"] = f"https://{cdn}/{prefix}trails/{self.id}.csv.gz"
-        else:
-            document["points"] = f"https://{bucket}.s3.amazonaws.com/{prefix}trails/{self.id}.csv.gz"
+        storage = get_storage()
+        document["points"] = storage.url(storage.trail_key(self.id))
 
         return document
 
+    class Meta:
+        indexes = [
+            # Range filters of explore
+            models.Index(fields=['length']),
+            models.Index(fields=['elv_gain']),
+            models.Index(fields=['difficulty', 'length']),
+        ]
+
 
 class Package(AttractionFilter):
     @classmethod
@@ -445,13 +520,6 @@ class TourLanguage(AttractionFilter):
         return "tour_languages"
 
 
-def filter_to_json(instance: Optional[AttractionFilter]) -> Optional[dict]:
-    if instance is None:
-        return None
-    else:
-        return instance.to_json
-
-
 class Tour(Attraction):
     @classmethod
     def short_related(cls) -> List[str]:
@@ -491,21 +559,28 @@ class Tour(Attraction):
 
         return query_set
 
-    @property
-    def to_short_json(self):
-        data = super(Tour, self).to_short_json
+    @classmethod
+    def facet_fields(cls) -> Dict[str, str]:
+        return {
+            **super().facet_fields(),
+            "destinations": "destinations",
+        }
 
-        # Add all the related fields
-        for related in self.short_related():
-            data[related] = filter_to_json(getattr(self, related))
+    @classmethod
+    def detail_prefetch(cls) -> List[str]:
+        return super().detail_prefetch() + ["destinations"]
 
-        data.update({
-            "length": str(self.tour_length),
-            "price": str(self.price),
-            "group": self.group,
-        })
+    @classmethod
+    def short_fields(cls) -> List[ShortField]:
+        # Add all the related fields
+        return super().short_fields() + list(map(filter_field, cls.short_related())) + [
+            ShortField("length", ("tour_length",), str),
+            ShortField("price", ("price",), str),
+            ShortField("group", ("group",)),
+        ]
 
-        return data
+    def search_texts(self) -> List[Tuple[Optional[str], str]]:
+        return super().search_texts() + [(self.description, "C")]
 
     @property
     def to_json(self):
@@ -701,3 +776,57 @@ class FilterModelConverter:
     @staticmethod
     def to_url(value: Type[Attraction]):
         return value.api_multiple_key()
+
+
+class ContentVersion(models.Model):
+    """
+    Version of the documents served for a model (keyed by api_multiple_key), bumped by
+    attractions2.signals on every change so conditional requests need a single row lookup
+    """
+    model = models.CharField(max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    last_modified = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"{self.model}: {self.version}"
+
+    @property
+    def etag(self) -> str:
+        # Weak, the same version is served in several content codings
+        return f'W/"{self.model}-{self.version}"'
+
+    @classmethod
+    def lookup(cls, key: str) -> 'ContentVersion':
+        try:
+            return cls.objects.get(model=key)
+        except cls.DoesNotExist:
+            # Nothing changed since versions are tracked
+            return cls(model=key)
+
+    @classmethod
+    def bump(cls, keys: List[str]):
+        now = timezone.now()
+
+        updated = cls.objects.filter(model__in=keys).update(version=F("version") + 1, last_modified=now)
+
+        if updated < len(keys):
+            existing = set(cls.objects.filter(model__in=keys).values_list("model", flat=True))
+
+            cls.objects.bulk_create([
+                cls(model=key, version=1, last_modified=now)
+                for key in keys
+                if key not in existing
+            ], ignore_conflicts=True)
+
+
+class AttractionChange(models.Model):
+    """
+    Append only log of attraction locations, written by attractions2.signals so the
+    in-memory spatial index of every process can catch up without reloading
+    """
+    attraction_id = models.BigIntegerField()
+    # Null when the attraction was deleted
+    lat = models.FloatField(null=True)
+    long = models.FloatField(null=True)
+    content_type_id = models.IntegerField(null=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
@@ -0,0 +1,313 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple, Type
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, QueryDict
+from django.utils.cache import patch_vary_headers
+from django.utils.http import urlencode
+
+from attractions2 import compression, models, tiles
+
+# Entries don't need to expire, a version bump makes them unreachable
+RESPONSE_TIMEOUT = 60 * 60 * 24
+
+
+def get_version(request, model) -> models.ContentVersion:
+    """
+    The content version of the model, looked up once per request since both the
+    conditional request handling and the cache key need it
+    """
+    if not hasattr(request, "content_versions"):
+        request.content_versions = {}
+
+    key = model.api_multiple_key()
+
+    if key not in request.content_versions:
+        request.content_versions[key] = models.ContentVersion.lookup(key)
+
+    return request.content_versions[key]
+
+
+def get_versions(request, categories: List[Type]) -> List[models.ContentVersion]:
+    """
+    get_version for several models, the ones not looked up yet are fetched in one query
+    """
+    if not hasattr(request, "content_versions"):
+        request.content_versions = {}
+
+    keys = [model.api_multiple_key() for model in categories]
+    missing = [key for key in keys if key not in request.content_versions]
+
+    if missing:
+        found = {
+            version.model: version
+            for version in models.ContentVersion.objects.filter(model__in=missing)
+        }
+
+        for key in missing:
+            # Nothing changed since versions are tracked
+            request.content_versions[key] = found.get(key, models.ContentVersion(model=key))
+
+    return [request.content_versions[key] for key in keys]
+
+
+def _normalize(value: str) -> str:
+    value = value.strip()
+
+    try:
+        return str(int(value))
+    except ValueError:
+        return value
+
+
+def canonical_query(query: QueryDict) -> str:
+    """
+    Order independent representation of the query string, repeated values
+    are sorted and deduplicated since every filter treats them as a set
+    """
+    return urlencode([
+        (key, sorted(set(map(_normalize, query.getlist(key)))))
+        for key in sorted(query.keys())
+    ], doseq=True)
+
+
+def _query_digest(query: QueryDict) -> str:
+    # Keys have a bounded length (250 characters in memcached, the column of the database cache)
+    return hashlib.sha1(canonical_query(query).encode("utf-8")).hexdigest()
+
+
+def explore_key(request, model: Type) -> str:
+    version = get_version(request, model).version
+
+    return f"explore:{model.api_multiple_key()}:{version}:{_query_digest(request.GET)}"
+
+
+def _combined_versions(request, categories: List[Type]) -> str:
+    versions = ",".join(
+        f"{version.model}-{version.version}"
+        for version in get_versions(request, categories)
+    )
+
+    return hashlib.sha1(versions.encode("utf-8")).hexdigest()
+
+
+def combined_explore_key(request, categories: List[Type]) -> str:
+    return f"explore:combined:{_combined_versions(request, categories)}:{_query_digest(request.GET)}"
+
+
+def combined_etag(request, categories: List[Type]) -> str:
+    return f'W/"combined-{_combined_versions(request, categories)}"'
+
+
+def combined_last_modified(request, categories: List[Type]) -> Optional[datetime]:
+    return max(
+        (
+            version.last_modified
+            for version in get_versions(request, categories)
+            if version.last_modified is not None
+        ),
+        default=None
+    )
+
+
+def cached_response(request, key: str, build: Callable[[], dict]) -> HttpResponse:
+    """
+    Serve the serialized document stored under key, or build, serialize and
+    store it when missing.
+
+    The compressed variant the client accepts is cached next to it, so hot
+    responses are compressed once rather than on every request.
+    """
+    coding = compression.negotiate(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+
+    if coding is not None:
+        body = cache.get(f"{key}:{coding}")
+
+        if body is not None:
+            return _response(body, coding)
+
+    body = cache.get(key)
+
+    if body is None:
+        body = json.dumps(build(), cls=DjangoJSONEncoder).encode("utf-8")
+        cache.set(key, body, RESPONSE_TIMEOUT)
+
+    if coding is not None and compression.is_compressible("application/json", len(body)):
+        compressed = compression.compress(body, coding)
+        cache.set(f"{key}:{coding}", compressed, RESPONSE_TIMEOUT)
+
+        return _response(compressed, coding)
+
+    return _response(body, None)
+
+
+def _response(body: bytes, coding: Optional[str]) -> HttpResponse:
+    response = HttpResponse(body, content_type="application/json")
+
+    if coding is not None:
+        response["Content-Encoding"] = coding
+
+    patch_vary_headers(response, ("Accept-Encoding",))
+
+    return response
+
+
+def dependency_key(model, pk) -> str:
+    """
+    Cache key of the token of an object detail documents depend on, attractions
+    share the key of the base model since signals may send either
+    """
+    if issubclass(model, models.Attraction):
+        model = models.Attraction
+
+    return f"dependency:{model._meta.label_lower}:{pk}"
+
+
+def detail_dependencies(single: models.Attraction) -> Set[str]:
+    """
+    The objects a detail document loaded by detail_query is built from
+    """
+    dependencies = {dependency_key(models.Attraction, single.pk)}
+
+    if single.main_image_id is not None:
+        dependencies.add(dependency_key(models.ImageAsset, single.main_image_id))
+
+    for name in single.detail_related():
+        field = single._meta.get_field(name)
+        related_id = getattr(single, field.attname)
+
+        if related_id is not None:
+            dependencies.add(dependency_key(field.related_model, related_id))
+
+    for name in single.detail_prefetch():
+        for related in getattr(single, name).all():
+            dependencies.add(dependency_key(type(related), related.pk))
+
+    return dependencies
+
+
+def _dependency_tokens(keys: Set[str]) -> Dict[str, str]:
+    tokens = cache.get_many(keys)
+
+    for key in keys - tokens.keys():
+        cache.add(key, uuid.uuid4().hex, None)
+
+    if len(tokens) < len(keys):
+        # Another request may have added the token first
+        tokens = cache.get_many(keys)
+
+    return tokens
+
+
+# Deleted by every invalidate, see store_detail
+DETAIL_GENERATION_KEY = "detail-generation"
+
+
+def detail_generation() -> str:
+    """
+    Read before loading the objects of detail documents and passed to store_detail
+    """
+    return _dependency_tokens({DETAIL_GENERATION_KEY})[DETAIL_GENERATION_KEY]
+
+
+def invalidate(model, *pks):
+    """
+    Make the detail documents depending on the objects stale, once the change is committed
+    """
+    # The generation first: a detail whose token is recreated after this must see it changed
+    cache.delete(DETAIL_GENERATION_KEY)
+    cache.delete_many([dependency_key(model, pk) for pk in pks])
+
+
+def _detail_key(model, attraction_id: int) -> str:
+    return f"detail:{model.api_multiple_key()}:{attraction_id}"
+
+
+def cached_details(attractions: List[Tuple[Type, int]]) -> Dict[Tuple[Type, int], dict]:
+    """
+    The cached detail documents which are still valid out of the (model, id) pairs,
+    two cache reads no matter how many
+    """
+    keys = {_detail_key(model, attraction_id): (model, attraction_id) for model, attraction_id in attractions}
+    entries = cache.get_many(keys.keys())
+
+    tokens = cache.get_many({token_key for _, entry_tokens in entries.values() for token_key in entry_tokens})
+
+    return {
+        keys[key]: document
+        for key, (document, entry_tokens) in entries.items()
+        if all(tokens.get(token_key) == token for token_key, token in entry_tokens.items())
+    }
+
+
+def store_detail(model, attraction_id: int, document: dict, dependencies: Set[str], generation: str):
+    """
+    Store a document built from objects loaded after detail_generation returned generation.
+
+    The tokens are only read now, one invalidated since the objects were loaded would be
+    recreated and stored with the stale document. Invalidations change the generation
+    first, so such a document isn't stored.
+    """
+    tokens = _dependency_tokens(dependencies)
+
+    if cache.get(DETAIL_GENERATION_KEY) != generation:
+        return
+
+    cache.set(_detail_key(model, attraction_id), (document, tokens), RESPONSE_TIMEOUT)
+
+
+def cached_detail(model, attraction_id: int, build: Callable[[], Tuple[dict, Set[str]]]) -> dict:
+    """
+    The detail document of the attraction, built (with its dependencies) when missing.
+
+    The document is stored with the tokens of its dependencies at build time,
+    invalidate deletes a token so exactly the documents built from the object
+    stop matching.
+    """
+    entry = cache.get(_detail_key(model, attraction_id))
+    if entry is not None:
+        document, tokens = entry
+
+        if cache.get_many(tokens.keys()) == tokens:
+            return document
+
+    generation = detail_generation()
+
+    document, dependencies = build()
+    store_detail(model, attraction_id, document, dependencies, generation)
+
+    return document
+
+
+# Deleted to make every cached tile stale, for changes which can't be located
+TILE_GENERATION_KEY = "tile-generation"
+
+
+def _tile_token_key(z: int, x: int, y: int) -> str:
+    return f"tile-token:{z}/{x}/{y}"
+
+
+def tile_key(request, z: int, x: int, y: int) -> str:
+    token_key = _tile_token_key(z, x, y)
+    tokens = _dependency_tokens({token_key, TILE_GENERATION_KEY})
+
+    return f"tile:{z}/{x}/{y}:{tokens[token_key]}:{tokens[TILE_GENERATION_KEY]}:{_query_digest(request.GET)}"
+
+
+def invalidate_tiles(*locations: Tuple[float, float]):
+    """
+    Make the cached tiles holding the (lat, long) locations stale at every zoom level
+    """
+    cache.delete_many([
+        _tile_token_key(z, *tiles.tile_for(lat, long, z))
+        for lat, long in locations
+        for z in range(tiles.MAX_ZOOM + 1)
+    ])
+
+
+def invalidate_all_tiles():
+    cache.delete(TILE_GENERATION_KEY)
@@ -0,0 +1,68 @@
+import re
+from typing import NamedTuple
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connection
+from django.db.models import F, FloatField, QuerySet
+from django.db.models.functions import Cast
+
+from attractions2.base_models import SEARCH_CONFIG, Attraction
+
+_WORD = re.compile(r"\w+")
+
+
+class SearchResults(NamedTuple):
+    # Ordered by (sort_field, id), most relevant first
+    query_set: QuerySet
+    sort_field: str
+    descending: bool
+
+
+def _prefix_query(q: str):
+    """
+    Every word of the query, the last one as a prefix since it's still being typed
+    """
+    words = _WORD.findall(q.lower())
+
+    if not words:
+        return None
+
+    terms = words[:-1] + [words[-1] + ":*"]
+
+    return SearchQuery(" & ".join(terms), search_type="raw", config=SEARCH_CONFIG)
+
+
+def search_attractions(q: str) -> SearchResults:
+    """
+    The attractions matching q, most relevant first.
+
+    On PostgreSQL the words are looked up in search_vector (GIN indexed) and ranked,
+    and when nothing matches the names are compared by trigram similarity so typos
+    still find something. Other databases fall back to a name substring match.
+    """
+    query_set = Attraction.objects.filter(content_type__isnull=False)
+
+    if connection.vendor != "postgresql":
+        return SearchResults(query_set.filter(name__icontains=q).order_by("name", "id"), "name", False)
+
+    query = _prefix_query(q)
+    if query is None:
+        return SearchResults(query_set.none(), "name", False)
+
+    # The rank and the similarity are real (float4), compared to the double of a keyset
+    # cursor they would never be equal, so they're cast to double precision
+    matches = query_set \
+        .filter(search_vector=query) \
+        .annotate(rank=Cast(SearchRank(F("search_vector"), query), FloatField())) \
+        .order_by("-rank", "-id")
+
+    if matches.exists():
+        return SearchResults(matches, "rank", True)
+
+    # The % operator (pg_trgm.similarity_threshold, 0.3 by default) uses the trigram index
+    similar = query_set \
+        .filter(name__trigram_similar=q) \
+        .annotate(similarity=Cast(TrigramSimilarity("name", q), FloatField())) \
+        .order_by("-similarity", "-id")
+
+    return SearchResults(similar, "similarity", True)
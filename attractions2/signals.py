@@ -0,0 +1,165 @@
+from typing import Optional
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from attractions2 import autocomplete, models, response_cache
+from attractions2.base_models import Attraction, AttractionFilter, GoogleUser, ImageAsset
+
+
+def _attraction_model(instance: Attraction):
+    # Generic attractions (e.g. saved by add_comment to update the rating) are
+    # resolved to their concrete model through the content type
+    if type(instance) is Attraction and instance.content_type_id is not None:
+        return ContentType.objects.get_for_id(instance.content_type_id).model_class()
+
+    return type(instance)
+
+
+def _invalidate(model, *pks):
+    # Once committed, a detail loaded before that would be stored with the new tokens
+    transaction.on_commit(lambda: response_cache.invalidate(model, *pks))
+
+
+def _bump(*keys: str):
+    models.ContentVersion.bump(list(keys))
+
+
+def _bump_all(*keys: str):
+    _bump(*keys, *[model.api_multiple_key() for model in models.get_attraction_classes()])
+
+
+@receiver(pre_save)
+def attraction_saving(sender, instance, **kwargs):
+    # Remember where the attraction was, the tiles it moves out of change too
+    if isinstance(instance, Attraction) and instance.pk is not None:
+        saved = Attraction.objects.filter(pk=instance.pk).values_list("lat", "long", "name").first()
+
+        if saved is not None:
+            instance._saved_location = saved[:2]
+            instance._saved_name = saved[2]
+
+
+@receiver(pre_save, sender=GoogleUser)
+def user_saving(sender, instance, **kwargs):
+    # Users are saved on every login, remember what the trails show of their owner
+    instance._saved_profile = GoogleUser.objects.filter(pk=instance.pk).values_list("name", "picture").first()
+
+
+def _profile_changed(user: GoogleUser, signal) -> bool:
+    # Only the name and the picture are shown, most saves are logins which change neither
+    if signal is post_delete:
+        return True
+
+    saved = getattr(user, "_saved_profile", None)
+
+    return saved is not None and saved != (user.name, user.picture)
+
+
+@receiver([post_save, post_delete])
+def content_changed(sender, instance, signal, created=False, **kwargs):
+    if isinstance(instance, (Attraction, AttractionFilter)) or \
+            (isinstance(instance, ImageAsset) and instance.parent_id is None):
+        # Detail documents built from the object
+        _invalidate(type(instance), instance.pk)
+
+    if isinstance(instance, Attraction):
+        _bump(_attraction_model(instance).api_multiple_key())
+
+        locations = [(instance.lat, instance.long)]
+        if getattr(instance, "_saved_location", None) is not None:
+            locations.append(instance._saved_location)
+
+        # Most saves (ratings) don't change the name
+        if signal is post_delete or created or instance.name != getattr(instance, "_saved_name", None):
+            _bump(autocomplete.VERSION_KEY)
+
+        # Once committed, so the tile isn't rebuilt from the previous data in the meantime
+        transaction.on_commit(lambda: response_cache.invalidate_tiles(*locations))
+
+        # For the spatial index of every process
+        if signal is post_delete:
+            models.AttractionChange.objects.create(attraction_id=instance.pk)
+        else:
+            models.AttractionChange.objects.create(
+                attraction_id=instance.pk,
+                lat=instance.lat,
+                long=instance.long,
+                content_type_id=instance.content_type_id
+            )
+    elif isinstance(instance, GoogleUser):
+        # The owner is embedded in the documents of the trails
+        if _profile_changed(instance, signal):
+            _invalidate(GoogleUser, instance.pk)
+            _bump(models.Trail.api_multiple_key())
+    elif isinstance(instance, AttractionFilter):
+        # Filters are embedded in the documents of all the attractions referring to them
+        _bump_all(instance.api_multiple_key(), autocomplete.VERSION_KEY)
+    elif isinstance(instance, ImageAsset) and instance.parent_id is None:
+        # Deleting an original clears main_image without signals on the attraction
+        if signal is post_delete:
+            _bump_all()
+            response_cache.invalidate_all_tiles()
+
+
+@receiver(m2m_changed)
+def attraction_relations_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    # The token of a related object (a filter or an image) is shared by the detail
+    # documents of all the attractions related to it
+    _invalidate(type(instance), instance.pk)
+
+    # Attractions added from the related side didn't depend on it yet
+    if reverse and pk_set:
+        _invalidate(model, *pk_set)
+
+    if isinstance(instance, Attraction):
+        _bump(_attraction_model(instance).api_multiple_key())
+    elif isinstance(instance, AttractionFilter):
+        _bump_all(instance.api_multiple_key())
+
+
+def _tagged_trail_ids(field: str, tag_id: int) -> list:
+    return list(models.Trail.objects.filter(**{field: tag_id}).values_list("pk", flat=True))
+
+
+def _trail_tag_field(through) -> Optional[str]:
+    for field in models.Trail.TAG_FIELDS:
+        if getattr(models.Trail, field).through is through:
+            return field
+
+
+@receiver(m2m_changed)
+def trail_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    field = _trail_tag_field(sender)
+    if field is None:
+        return
+
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            models.Trail.sync_tag_masks([instance.pk])
+    elif action == "pre_clear":
+        # The trails are gone from the relation after the clear, remember them
+        instance._cleared_trail_ids = _tagged_trail_ids(field, instance.pk)
+    elif action == "post_clear":
+        models.Trail.sync_tag_masks(getattr(instance, "_cleared_trail_ids", []))
+    elif action in ("post_add", "post_remove"):
+        models.Trail.sync_tag_masks(pk_set)
+
+
+@receiver(pre_delete)
+def trail_tag_deleting(sender, instance, **kwargs):
+    # The database cascade drops the relation rows without m2m_changed
+    for field in models.Trail.TAG_FIELDS:
+        if isinstance(instance, getattr(models.Trail, field).field.related_model):
+            instance._tagged_trail_ids = _tagged_trail_ids(field, instance.pk)
+
+
+@receiver(post_delete)
+def trail_tag_deleted(sender, instance, **kwargs):
+    if hasattr(instance, "_tagged_trail_ids"):
+        models.Trail.sync_tag_masks(instance._tagged_trail_ids)
@@ -0,0 +1,185 @@
+import math
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from django.db.models import Q
+
+from attractions2 import models
+
+# Grid cells of 0.05 degrees, about 5km
+CELL_SIZE = 0.05
+
+# How often (in seconds) the change log is checked for new entries
+REFRESH_INTERVAL = 5
+
+# The index is rebuilt from the attraction table this often (in seconds),
+# the change log only has to be kept for longer than that
+REBUILD_INTERVAL = 60 * 60
+
+# Ids are assigned when a change is written but become visible when its transaction
+# commits, a lower id may show up after a higher one was read. Missing ids are looked
+# for again until they're this old (in seconds), after that their transaction is
+# assumed to have rolled back
+GAP_TIMEOUT = 5 * 60
+
+# Ids before the position in the log looked at for gaps when the index is built
+BUILD_GAP_WINDOW = 1000
+
+
+class Entry(NamedTuple):
+    id: int
+    lat: float
+    long: float
+    content_type_id: int
+
+
+def _cell(lat: float, long: float) -> Tuple[int, int]:
+    return math.floor(long / CELL_SIZE), math.floor(lat / CELL_SIZE)
+
+
+class GridIndex:
+    """
+    Uniform grid over the locations of all the attractions, answers bounding box
+    queries from memory
+    """
+
+    def __init__(self):
+        self.cells = defaultdict(dict)  # type: Dict[Tuple[int, int], Dict[int, Entry]]
+        self.entries = {}  # type: Dict[int, Entry]
+        self.last_change_id = 0
+        # Missing ids before last_change_id, and when they were noticed
+        self.gaps = {}  # type: Dict[int, float]
+        self.refreshed = 0.0
+        self.built = 0.0
+        self.lock = threading.Lock()
+
+    def _put(self, entry: Entry):
+        self._remove(entry.id)
+
+        self.entries[entry.id] = entry
+        self.cells[_cell(entry.lat, entry.long)][entry.id] = entry
+
+    def _remove(self, attraction_id: int):
+        entry = self.entries.pop(attraction_id, None)
+
+        if entry is not None:
+            cell = _cell(entry.lat, entry.long)
+            del self.cells[cell][attraction_id]
+
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def _add_gaps(self, first: int, last: int, seen: Iterable[int], now: float):
+        # The ids in [first, last) that weren't seen
+        for change_id in set(range(first, last)).difference(seen):
+            self.gaps.setdefault(change_id, now)
+
+    def build(self):
+        # The position in the log first, changes made while loading are replayed
+        last_change = models.AttractionChange.objects.order_by("-id").values_list("id", flat=True).first() or 0
+        first = max(last_change - BUILD_GAP_WINDOW, 1)
+        recent = models.AttractionChange.objects.filter(id__gte=first).values_list("id", flat=True)
+
+        self.cells = defaultdict(dict)
+        self.entries = {}
+
+        for row in models.Attraction.objects \
+                .filter(content_type__isnull=False) \
+                .values_list("id", "lat", "long", "content_type_id") \
+                .iterator():
+            self._put(Entry(*row))
+
+        now = time.monotonic()
+
+        self.gaps = {}
+        self._add_gaps(first, last_change, recent, now)
+        self.last_change_id = last_change
+        self.built = self.refreshed = now
+
+    def refresh(self):
+        now = time.monotonic()
+        self.gaps = {change_id: noticed for change_id, noticed in self.gaps.items() if now - noticed < GAP_TIMEOUT}
+
+        new_changes = Q(id__gt=self.last_change_id)
+        if self.gaps:
+            new_changes |= Q(id__in=list(self.gaps))
+
+        changes = models.AttractionChange.objects \
+            .filter(new_changes) \
+            .order_by("id") \
+            .values_list("id", "attraction_id", "lat", "long", "content_type_id")
+
+        # A change filling a gap comes before a later change of the same attraction, the
+        # later one waited for the lock on the attraction row
+        for change_id, attraction_id, lat, long, content_type_id in changes:
+            if lat is None or content_type_id is None:
+                self._remove(attraction_id)
+            else:
+                self._put(Entry(attraction_id, lat, long, content_type_id))
+
+            if change_id > self.last_change_id:
+                self._add_gaps(self.last_change_id + 1, change_id, (), now)
+                self.last_change_id = change_id
+            else:
+                self.gaps.pop(change_id, None)
+
+        self.refreshed = now
+
+    def _ensure_fresh(self, refresh: bool):
+        now = time.monotonic()
+
+        if not self.built or now - self.built > REBUILD_INTERVAL:
+            self.build()
+        elif refresh or now - self.refreshed > REFRESH_INTERVAL:
+            self.refresh()
+
+    def query(self, west: float, south: float, east: float, north: float,
+              content_type_ids: Optional[Set[int]] = None, refresh: bool = False,
+              half_open: bool = False) -> List[Entry]:
+        """
+        The entries with west <= long <= east and south <= lat <= north (or < east and
+        < north when half_open, like adjacent tiles), refresh reads the change log even
+        if it was read less than REFRESH_INTERVAL ago. The bounds must be finite.
+        """
+        min_x, min_y = _cell(south, west)
+        max_x, max_y = _cell(north, east)
+
+        def inside(entry: Entry) -> bool:
+            if half_open:
+                return west <= entry.long < east and south <= entry.lat < north
+
+            return west <= entry.long <= east and south <= entry.lat <= north
+
+        # Refreshes and rebuilds change the cells in place, they're read under the lock
+        with self.lock:
+            self._ensure_fresh(refresh)
+
+            # A large box has more cells than there are occupied ones
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+                cells = [
+                    cell for (x, y), cell in self.cells.items()
+                    if min_x <= x <= max_x and min_y <= y <= max_y
+                ]
+            else:
+                cells = [
+                    self.cells[(x, y)]
+                    for x in range(min_x, max_x + 1)
+                    for y in range(min_y, max_y + 1)
+                    if (x, y) in self.cells
+                ]
+
+            return [
+                entry
+                for cell in cells
+                for entry in cell.values()
+                if inside(entry) and (content_type_ids is None or entry.content_type_id in content_type_ids)
+            ]
+
+
+_index = GridIndex()
+
+
+def get_index() -> GridIndex:
+    return _index
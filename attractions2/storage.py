@@ -0,0 +1,239 @@
+import abc
+import functools
+import io
+import logging
+import os
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import boto3
+import pytz
+import requests
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+# Maximum number of keys S3 accepts in a single delete_objects request
+DELETE_BATCH_SIZE = 1000
+
+# Assets are immutable, a new key is generated for every upload
+CACHE_CONTROL = "public, max-age=2592000"
+
+
+class AssetStorage(abc.ABC):
+    """
+    Where image assets and trail points are kept, selected by ASSETS["backend"].
+
+    Objects are uploaded to the configured bucket. Assets keep the bucket they were
+    uploaded to, it's passed to open, delete and url (the configured one by default).
+    """
+
+    def __init__(self, bucket: str, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def new_image_key(self, ext: str) -> str:
+        return self.prefix + "images/" + str(uuid.uuid4()) + ext
+
+    def trail_key(self, trail_id: int) -> str:
+        return self.prefix + "trails/" + str(trail_id) + ".csv.gz"
+
+    @abc.abstractmethod
+    def upload(self, fh: BinaryIO, key: str, content_type: str, content_encoding: Optional[str] = None):
+        raise NotImplementedError("upload is not implemented")
+
+    @abc.abstractmethod
+    def open(self, key: str, bucket: Optional[str] = None) -> BinaryIO:
+        raise NotImplementedError("open is not implemented")
+
+    @abc.abstractmethod
+    def delete(self, keys: List[str], bucket: Optional[str] = None) -> List[str]:
+        """
+        Delete the keys, returns the keys that failed to delete
+        """
+        raise NotImplementedError("delete is not implemented")
+
+    @abc.abstractmethod
+    def list(self, prefix: str) -> Iterator[List[Tuple[str, datetime]]]:
+        """
+        Iterate the (key, last modified) pairs under prefix, a page at a time
+        """
+        raise NotImplementedError("list is not implemented")
+
+    @abc.abstractmethod
+    def url(self, key: str, bucket: Optional[str] = None) -> str:
+        raise NotImplementedError("url is not implemented")
+
+
+class S3Storage(AssetStorage):
+    def __init__(self, bucket: str, prefix: str, config: dict, cdn: Optional[str] = None):
+        super().__init__(bucket, prefix)
+        self.config = config
+        self.cdn = cdn
+
+    @functools.cached_property
+    def client(self):
+        return boto3.client("s3", **self.config)
+
+    def upload(self, fh: BinaryIO, key: str, content_type: str, content_encoding: Optional[str] = None):
+        extra_args = {
+            "ContentType": content_type,
+            "ACL": "public-read",
+            "CacheControl": CACHE_CONTROL
+        }
+
+        if content_encoding is not None:
+            extra_args["ContentEncoding"] = content_encoding
+
+        self.client.upload_fileobj(fh, self.bucket, key, ExtraArgs=extra_args)
+
+    def open(self, key: str, bucket: Optional[str] = None) -> BinaryIO:
+        return requests.get(self.url(key, bucket), stream=True).raw
+
+    def delete(self, keys: List[str], bucket: Optional[str] = None) -> List[str]:
+        bucket = bucket or self.bucket
+        failed = []
+
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            response = self.client.delete_objects(
+                Bucket=bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[start:start + DELETE_BATCH_SIZE]],
+                    "Quiet": True
+                }
+            )
+
+            for error in response.get("Errors", []):
+                log.error("failed to delete s3://%s/%s: %s", bucket, error["Key"], error.get("Message"))
+                failed.append(error["Key"])
+
+        return failed
+
+    def list(self, prefix: str) -> Iterator[List[Tuple[str, datetime]]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield [(item["Key"], item["LastModified"]) for item in page.get("Contents", [])]
+
+    def url(self, key: str, bucket: Optional[str] = None) -> str:
+        if self.cdn is not None:
+            return f"https://{self.cdn}/{key}"
+        else:
+            return f"https://{bucket or self.bucket}.s3.amazonaws.com/{key}"
+
+
+class LocalStorage(AssetStorage):
+    """
+    Keeps the objects under root, whatever their bucket
+    """
+
+    def __init__(self, bucket: str, prefix: str, root: str, base_url: str):
+        super().__init__(bucket, prefix)
+        self.root = Path(root)
+        self.base_url = base_url
+
+    def upload(self, fh: BinaryIO, key: str, content_type: str, content_encoding: Optional[str] = None):
+        target = self.root / key
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(target, "wb") as out:
+            for chunk in iter(lambda: fh.read(64 * 1024), b""):
+                out.write(chunk)
+
+    def open(self, key: str, bucket: Optional[str] = None) -> BinaryIO:
+        return open(self.root / key, "rb")
+
+    def delete(self, keys: List[str], bucket: Optional[str] = None) -> List[str]:
+        for key in keys:
+            try:
+                os.remove(self.root / key)
+            except FileNotFoundError:
+                pass
+
+        return []
+
+    def list(self, prefix: str) -> Iterator[List[Tuple[str, datetime]]]:
+        page = []
+
+        for directory, _dirs, files in os.walk(self.root):
+            for name in files:
+                full_path = Path(directory) / name
+                key = full_path.relative_to(self.root).as_posix()
+
+                if key.startswith(prefix):
+                    modified = datetime.fromtimestamp(full_path.stat().st_mtime, tz=pytz.UTC)
+                    page.append((key, modified))
+
+                if len(page) == DELETE_BATCH_SIZE:
+                    yield page
+                    page = []
+
+        if page:
+            yield page
+
+    def url(self, key: str, bucket: Optional[str] = None) -> str:
+        return self.base_url + key
+
+
+class MemoryStorage(AssetStorage):
+    """
+    Keeps the objects in the process memory whatever their bucket, meant for tests and
+    offline benchmarks
+    """
+
+    def __init__(self, bucket: str, prefix: str, base_url: str):
+        super().__init__(bucket, prefix)
+        self.base_url = base_url
+        self.objects = {}  # type: Dict[str, Tuple[bytes, datetime]]
+
+    def upload(self, fh: BinaryIO, key: str, content_type: str, content_encoding: Optional[str] = None):
+        self.objects[key] = (fh.read(), datetime.utcnow().replace(tzinfo=pytz.UTC))
+
+    def open(self, key: str, bucket: Optional[str] = None) -> BinaryIO:
+        return io.BytesIO(self.objects[key][0])
+
+    def delete(self, keys: List[str], bucket: Optional[str] = None) -> List[str]:
+        for key in keys:
+            self.objects.pop(key, None)
+
+        return []
+
+    def list(self, prefix: str) -> Iterator[List[Tuple[str, datetime]]]:
+        keys = sorted(key for key in self.objects if key.startswith(prefix))
+
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            yield [(key, self.objects[key][1]) for key in keys[start:start + DELETE_BATCH_SIZE]]
+
+    def url(self, key: str, bucket: Optional[str] = None) -> str:
+        return self.base_url + key
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage() -> AssetStorage:
+    assets = settings.ASSETS
+    backend = assets.get("backend", "s3")
+
+    if backend == "s3":
+        return S3Storage(
+            bucket=assets["bucket"],
+            prefix=assets["prefix"],
+            config=assets["config"],
+            cdn=assets.get("cdn")
+        )
+    elif backend == "local":
+        return LocalStorage(
+            bucket=assets.get("bucket", "local"),
+            prefix=assets.get("prefix", ""),
+            root=assets["root"],
+            base_url=assets.get("base_url", "/assets/")
+        )
+    elif backend == "memory":
+        return MemoryStorage(
+            bucket=assets.get("bucket", "memory"),
+            prefix=assets.get("prefix", ""),
+            base_url=assets.get("base_url", "/assets/")
+        )
+    else:
+        raise ValueError(f"unknown assets backend: {backend}")
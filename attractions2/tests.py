@@ -1,7 +1,37 @@
 # Create your tests here.
+import base64
+import gzip
+import io
+import json
+import time
+import unittest
+import uuid
+from datetime import datetime, timedelta
 from pathlib import Path
-from unittest import TestCase
+from typing import List
+from unittest import TestCase, mock
+
+import jwt
+import pytz
+from PIL import Image
+from django import test
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse, JsonResponse
+
+from attractions2 import (
+    api_views, autocomplete, compression, forms, geohash, google_keys, models, response_cache, spatial_index, tiles
+)
+from attractions2.base_models import SEARCH_CONFIG, Region
+from attractions2.keyset import InvalidCursor, decode_cursor, encode_cursor
+from attractions2.search import search_attractions
+from attractions2.storage import get_storage
 from attractions2.trail import analyze_trail
+from hland.middleware import CompressionMiddleware
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -15,3 +45,1460 @@ class TrailAnalysisTest(TestCase):
         self.assertAlmostEqual(analysis.center_latitude, 31.81994832796412)
         self.assertAlmostEqual(analysis.center_longitude, 35.25593624223869)
         self.assertEqual(int(analysis.distance), 3281)
+
+
+class KeysetCursorTest(TestCase):
+    def test_round_trip(self):
+        visited = datetime(2022, 5, 15, 6, 8, 1, 123456, tzinfo=pytz.UTC)
+
+        sort_value, last_id = decode_cursor(encode_cursor([visited, 12]))
+
+        self.assertEqual(datetime.fromisoformat(sort_value), visited)
+        self.assertEqual(last_id, 12)
+
+    def test_malformed(self):
+        with self.assertRaises(InvalidCursor):
+            decode_cursor("not a cursor")
+
+        with self.assertRaises(InvalidCursor):
+            decode_cursor(encode_cursor(["name"]))
+
+        # The id must be a number
+        for last_id in ("abc", True, 1.5, None):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(encode_cursor(["name", last_id]))
+
+
+class GeohashTest(TestCase):
+    def test_encode(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11), "u4pruydqqvj")
+        self.assertEqual(geohash.encode(31.77898, 35.23591, 5), "sv9hc")
+
+    def test_neighbours(self):
+        self.assertEqual(
+            sorted(geohash.neighbours(57.64911, 10.40744, 5)),
+            sorted(["u4pru", "u4r2h", "u4r2j", "u4prv", "u4prt", "u4prs", "u4pre", "u4prg", "u4r25"])
+        )
+
+    def test_neighbours_wrap(self):
+        cells = geohash.neighbours(0.1, 179.99, 3)
+
+        self.assertIn(geohash.encode(0.1, -179.99, 3), cells)
+
+    def test_distance(self):
+        # Jerusalem to Tel Aviv
+        self.assertAlmostEqual(geohash.distance(31.7683, 35.2137, 32.0853, 34.7818) / 1000, 54, delta=1)
+
+
+class SuggestIndexTest(test.TestCase):
+    def setUp(self):
+        region = Region.objects.create(name="Jerusalem")
+        domain = models.MuseumDomain.objects.create(name="Art")
+
+        for name in ["Israel Museum", "Tower of David Museum"]:
+            models.Museum.objects.create(
+                name=name, lat=31.77, long=35.21, address="Street", region=region, domain=domain
+            )
+
+        self.index = autocomplete.SuggestIndex()
+
+    def names(self, q: str):
+        return [suggestion.name for suggestion in self.index.suggest(q, 10)]
+
+    def test_prefix(self):
+        self.assertEqual(self.names("ISR"), ["Israel Museum"])
+        self.assertEqual(self.names("tower mu"), ["Tower of David Museum"])
+        # Any word, the shorter name first
+        self.assertEqual(self.names("mus"), ["Israel Museum", "Tower of David Museum"])
+
+    def test_filters(self):
+        self.assertEqual(self.index.suggest("jer", 10)[0].to_json(), {
+            "id": Region.objects.get().id,
+            "name": "Jerusalem",
+            "filter": "regions",
+        })
+
+    def test_fuzzy(self):
+        self.assertEqual(self.names("israle"), ["Israel Museum"])
+
+
+class SearchPaginationTest(test.TestCase):
+    def setUp(self):
+        self.region = Region.objects.create(name="Region")
+        self.domain = models.MuseumDomain.objects.create(name="Domain")
+
+    def create(self, name: str, description: str = ""):
+        return models.Museum.objects.create(
+            name=name, lat=31.77, long=35.21, address="Street", description=description,
+            region=self.region, domain=self.domain
+        )
+
+    def walk(self, q: str, limit: int) -> list:
+        pages = []
+        cursor = None
+
+        while True:
+            params = {"q": q, "limit": limit}
+            if cursor:
+                params["cursor"] = cursor
+
+            page = self.client.get("/attractions/api/search", params).json()["page"]
+            pages.append(page)
+
+            if not page["has_more"]:
+                return pages
+
+            cursor = page["next_cursor"]
+
+    def test_keyset(self):
+        for name in ["Museum A", "Museum B", "Museum C"]:
+            self.create(name)
+
+        first = self.client.get("/attractions/api/search", {"q": "museum", "limit": 2, "count": "true"}).json()["page"]
+        self.assertEqual(len(first["items"]), 2)
+        self.assertTrue(first["has_more"])
+        self.assertEqual(first["count"], 3)
+        self.assertNotIn("num_pages", first)
+
+        last = self.client.get("/attractions/api/search", {
+            "q": "museum", "limit": 2, "cursor": first["next_cursor"]
+        }).json()["page"]
+        self.assertEqual(len(last["items"]), 1)
+        self.assertFalse(last["has_more"])
+        self.assertNotIn("count", last)
+
+        names = [item["name"] for page in [first, last] for item in page["items"]]
+        self.assertEqual(sorted(names), ["Museum A", "Museum B", "Museum C"])
+
+        if connection.vendor != "postgresql":
+            self.assertEqual(names, ["Museum A", "Museum B", "Museum C"])
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "Ranked search needs PostgreSQL")
+    def test_ranked_pages(self):
+        # Different ranks, and ties between the museums with the same description
+        museums = [self.create(f"Museum {i}", "museum " * (i % 5)) for i in range(13)]
+
+        pages = self.walk("museum", 3)
+        ids = [item["id"] for page in pages for item in page["items"]]
+
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(set(ids), {museum.id for museum in museums})
+
+        # The more the description mentions the query, the higher the rank
+        ranked = {museum.id: i % 5 for i, museum in enumerate(museums)}
+        self.assertEqual([ranked[i] for i in ids], sorted([ranked[i] for i in ids], reverse=True))
+
+
+class MaxAgeTest(TestCase):
+    def test_parse(self):
+        self.assertEqual(google_keys.parse_max_age("public, max-age=22016, must-revalidate, no-transform"), 22016)
+        self.assertEqual(google_keys.parse_max_age('Max-Age="60"'), 60)
+        self.assertIsNone(google_keys.parse_max_age("public"))
+        self.assertIsNone(google_keys.parse_max_age("no-cache, max-age=60"))
+        self.assertIsNone(google_keys.parse_max_age(None))
+
+
+class GoogleKeysTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.responses = []
+
+        clock = mock.patch.object(google_keys, "time")
+        clock.start().monotonic.side_effect = lambda: self.now
+        self.addCleanup(clock.stop)
+
+        get = mock.patch.object(google_keys.requests, "get")
+        self.get = get.start()
+        self.get.side_effect = lambda *args, **kwargs: self.responses.pop(0)
+        self.addCleanup(get.stop)
+
+        self.keys = google_keys.GoogleKeys()
+
+    def respond(self, *kids: str, max_age: int = 100):
+        response = mock.Mock(headers={"Cache-Control": f"public, max-age={max_age}"})
+        response.json.return_value = {
+            "keys": [{"kty": "oct", "kid": kid, "k": "c2VjcmV0", "alg": "HS256"} for kid in kids]
+        }
+        self.responses.append(response)
+
+    def test_expiry(self):
+        self.respond("a")
+        self.assertEqual(self.keys.get_signing_key("a").key_id, "a")
+
+        self.now = 50
+        self.keys.get_signing_key("a")
+        self.assertEqual(self.get.call_count, 1)
+
+        # Google rotated the keys meanwhile
+        self.now = 101
+        self.respond("b")
+
+        self.assertEqual(self.keys.get_signing_key("b").key_id, "b")
+        self.assertEqual(self.get.call_count, 2)
+        self.assertNotIn("a", self.keys.keys)
+
+    def test_background_refresh(self):
+        self.respond("a")
+        self.keys.get_signing_key("a")
+
+        # Past REFRESH_AFTER the current key is returned while the thread refetches
+        self.now = 90
+        self.respond("a", "b")
+
+        self.assertEqual(self.keys.get_signing_key("a").key_id, "a")
+
+        deadline = time.monotonic() + 5
+        while self.keys.refreshing and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertFalse(self.keys.refreshing)
+        self.assertEqual(self.get.call_count, 2)
+        self.assertEqual(set(self.keys.keys), {"a", "b"})
+        self.assertEqual(self.keys.expires, 190)
+
+    def test_unknown_kid(self):
+        self.respond("a")
+        self.keys.get_signing_key("a")
+
+        # Too soon after the last fetch
+        self.now = google_keys.MIN_REFETCH_INTERVAL - 1
+        with self.assertRaises(jwt.PyJWKClientError):
+            self.keys.get_signing_key("b")
+
+        self.assertEqual(self.get.call_count, 1)
+
+        self.now = google_keys.MIN_REFETCH_INTERVAL
+        self.respond("a", "b")
+
+        self.assertEqual(self.keys.get_signing_key("b").key_id, "b")
+        self.assertEqual(self.get.call_count, 2)
+
+        # The refetch only happens once per interval
+        with self.assertRaises(jwt.PyJWKClientError):
+            self.keys.get_signing_key("c")
+
+        self.assertEqual(self.get.call_count, 2)
+
+
+# The queries of the database cache aren't counted
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class DetailQueryTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        image = models.ImageAsset.objects.create(bucket="bucket", key="image.png", size=1, width=100, height=100)
+        additional = models.ImageAsset.objects.create(bucket="bucket", key="other.png", size=1, width=100, height=100)
+
+        self.museum = models.Museum.objects.create(
+            name="Museum",
+            lat=31.77,
+            long=35.21,
+            address="Street",
+            region=Region.objects.create(name="Region"),
+            domain=models.MuseumDomain.objects.create(name="Domain"),
+            main_image=image,
+        )
+        self.museum.additional_images.add(additional)
+
+        self.trail = models.Trail.objects.create(
+            name="Trail",
+            lat=31.77,
+            long=35.21,
+            difficulty="E",
+            length=1000,
+            elv_gain=10,
+            owner=models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True),
+            main_image=image,
+        )
+        self.trail.activities.add(models.TrailActivity.objects.create(name="Activity"))
+        self.trail.attractions.add(models.TrailAttraction.objects.create(name="Attraction"))
+        self.trail.additional_images.add(additional)
+
+    def test_museum(self):
+        # The content version, the museum with its filters, the additional images and the thumbnails
+        with self.assertNumQueries(4):
+            response = self.client.get(f"/attractions/api/museums/{self.museum.id}", HTTP_ACCEPT_ENCODING="")
+
+        museum = response.json()["museum"]
+        self.assertEqual(museum["domain"]["name"], "Domain")
+        self.assertEqual(len(museum["additional_images"]), 1)
+
+    def test_trail(self):
+        # The content version, the trail with its owner, the additional images, the three
+        # tag sets and the thumbnails
+        with self.assertNumQueries(7):
+            response = self.client.get(f"/attractions/api/trails/{self.trail.id}", HTTP_ACCEPT_ENCODING="")
+
+        trail = response.json()["trail"]
+        self.assertEqual(trail["activities"][0]["name"], "Activity")
+        self.assertEqual(trail["suitabilities"], [])
+
+
+class DetailCacheTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.region = Region.objects.create(name="Region")
+        self.domain = models.MuseumDomain.objects.create(name="Domain")
+
+        self.museum = models.Museum.objects.create(
+            name="Museum", lat=31.77, long=35.21, address="Street", region=self.region, domain=self.domain
+        )
+
+    def detail(self) -> dict:
+        return self.client.get(f"/attractions/api/museums/{self.museum.id}").json()["museum"]
+
+    def test_related_changed(self):
+        self.assertEqual(self.detail()["domain"]["name"], "Domain")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.domain.name = "New domain"
+            self.domain.save()
+
+        self.assertEqual(self.detail()["domain"]["name"], "New domain")
+
+    def test_images_added(self):
+        self.assertEqual(self.detail()["additional_images"], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.museum.additional_images.add(
+                models.ImageAsset.objects.create(bucket="bucket", key="image.png", size=1, width=100, height=100)
+            )
+
+        self.assertEqual(len(self.detail()["additional_images"]), 1)
+
+    def test_batch(self):
+        def names():
+            response = self.client.get("/attractions/api/details", {"ids": self.museum.id})
+            return [attraction["region"]["name"] for attraction in response.json()["attractions"]]
+
+        self.assertEqual(names(), ["Region"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.region.name = "New region"
+            self.region.save()
+
+        self.assertEqual(names(), ["New region"])
+
+    def test_owner_changed(self):
+        owner = models.GoogleUser.objects.create(id=uuid.uuid4(), name="Bob", anonymized=False)
+        trail = models.Trail.objects.create(
+            name="Trail", lat=31.77, long=35.21, difficulty="E", length=1000, elv_gain=10, owner=owner
+        )
+        url = f"/attractions/api/trails/{trail.id}"
+
+        etag = self.client.get(url)["ETag"]
+        generation = response_cache.detail_generation()
+
+        # A login without changes keeps the version and the cached documents
+        with self.captureOnCommitCallbacks(execute=True):
+            owner.save()
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(response_cache.detail_generation(), generation)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            owner.name = "Alice"
+            owner.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["trail"]["owner"]["name"], "Alice")
+
+    def test_invalidated_while_building(self):
+        def build():
+            # The museum changes after it was loaded, the document is stale
+            response_cache.invalidate(models.Museum, self.museum.id)
+
+            return {"name": "Museum"}, {response_cache.dependency_key(models.Museum, self.museum.id)}
+
+        response_cache.cached_detail(models.Museum, self.museum.id, build)
+
+        self.assertEqual(response_cache.cached_details([(models.Museum, self.museum.id)]), {})
+
+
+@test.override_settings(ASSETS={"bucket": "current", "prefix": "", "config": {}})
+class AssetBucketTest(test.TestCase):
+    def setUp(self):
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+
+        self.storage = get_storage()
+        self.storage.client = mock.Mock()
+        self.storage.client.delete_objects.return_value = {}
+
+    def create(self, bucket: str, key: str, parent=None):
+        return models.ImageAsset.objects.create(bucket=bucket, key=key, size=1, width=10, height=10, parent=parent)
+
+    def deleted(self):
+        return sorted(
+            (call.kwargs["Bucket"], sorted(item["Key"] for item in call.kwargs["Delete"]["Objects"]))
+            for call in self.storage.client.delete_objects.call_args_list
+        )
+
+    def test_url(self):
+        self.assertEqual(self.create("previous", "a.png").url, "https://previous.s3.amazonaws.com/a.png")
+        self.assertEqual(self.create("current", "b.png").url, "https://current.s3.amazonaws.com/b.png")
+
+    def test_delete(self):
+        original = self.create("previous", "a.png")
+        self.create("current", "a-thumb.png", parent=original)
+
+        original.delete()
+
+        self.assertEqual(self.deleted(), [("current", ["a-thumb.png"]), ("previous", ["a.png"])])
+
+    def test_delete_many(self):
+        assets = [self.create("previous", "a.png"), self.create("previous", "b.png"), self.create("current", "c.png")]
+
+        models.ImageAsset.delete_many(assets)
+
+        self.assertEqual(self.deleted(), [("current", ["c.png"]), ("previous", ["a.png", "b.png"])])
+
+
+@test.override_settings(ASSETS={"backend": "memory", "bucket": "memory", "prefix": "assets/"})
+class ReconcileAssetsTest(test.TestCase):
+    def setUp(self):
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+
+        self.storage = get_storage()
+
+        owner = models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+        self.trail = models.Trail.objects.create(
+            name="Trail", lat=31.77, long=35.21, difficulty="E", length=1000, elv_gain=10, owner=owner
+        )
+
+    def put(self, key: str, hours: int = 48):
+        self.storage.objects[key] = (b"data", datetime.now(pytz.UTC) - timedelta(hours=hours))
+
+    def asset(self, key: str, parent=None):
+        self.put(key)
+
+        return models.ImageAsset.objects.create(bucket="memory", key=key, size=1, width=10, height=10, parent=parent)
+
+    def reconcile(self, *args) -> str:
+        out = io.StringIO()
+        call_command("reconcile_assets", *args, stdout=out)
+
+        return out.getvalue()
+
+    def test_orphaned(self):
+        self.asset("assets/images/known.png")
+        self.put("assets/images/orphan.png")
+        self.put(self.storage.trail_key(self.trail.id))
+        self.put(self.storage.trail_key(self.trail.id + 1))
+        # Uploads write the object before the row
+        self.put("assets/images/young.png", hours=1)
+        # Outside the prefix
+        self.put("other/images/orphan.png")
+
+        output = self.reconcile()
+
+        self.assertEqual(sorted(self.storage.objects), [
+            "assets/images/known.png",
+            "assets/images/young.png",
+            self.storage.trail_key(self.trail.id),
+            "other/images/orphan.png",
+        ])
+        self.assertIn("2 orphaned objects deleted", output)
+
+    def test_deleted_parent(self):
+        original = self.asset("assets/images/original.png")
+        self.asset("assets/images/thumb.png", parent=original)
+
+        # The thumbnail row goes with its parent, its object is left for the sweep
+        models.ImageAsset.objects.filter(id=original.id).delete()
+        self.assertEqual(len(self.storage.objects), 2)
+
+        self.reconcile()
+
+        self.assertEqual(self.storage.objects, {})
+
+    def test_missing(self):
+        # Rows whose object is gone are left alone
+        asset = self.asset("assets/images/missing.png")
+        del self.storage.objects[asset.key]
+
+        output = self.reconcile()
+
+        self.assertTrue(models.ImageAsset.objects.filter(id=asset.id).exists())
+        self.assertIn("0 orphaned objects deleted", output)
+
+    def test_dry_run(self):
+        self.put("assets/images/orphan.png")
+
+        output = self.reconcile("--dry-run")
+
+        self.assertEqual(list(self.storage.objects), ["assets/images/orphan.png"])
+        self.assertIn("orphan: /assets/assets/images/orphan.png", output)
+        self.assertIn("1 orphaned objects found", output)
+
+
+@test.override_settings(ASSETS={"backend": "memory", "perceptual_threshold": 4})
+class ImageDedupTest(test.TestCase):
+    def setUp(self):
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+
+        self.museum = models.Museum.objects.create(
+            name="Museum", lat=31.77, long=35.21, address="Street",
+            region=Region.objects.create(name="Region"),
+            domain=models.MuseumDomain.objects.create(name="Domain")
+        )
+
+    @staticmethod
+    def picture(dot: bool = False, image_format: str = "PNG") -> SimpleUploadedFile:
+        # A gradient, its perceptual hash doesn't depend on small changes or compression
+        im = Image.new("L", (90, 80))
+        im.putdata([x * 255 // 90 for _ in range(80) for x in range(90)])
+        im = im.convert("RGB")
+
+        # A different file with the same perceptual hash
+        if dot:
+            im.putpixel((0, 0), (255, 0, 0))
+
+        # Phones tag their photos with the orientation, upload_image expects it
+        exif = Image.Exif()
+        exif[0x0112] = 1
+
+        with io.BytesIO() as fh:
+            im.save(fh, image_format, exif=exif.tobytes())
+
+            return SimpleUploadedFile(f"image.{image_format.lower()}", fh.getvalue(), f"image/{image_format.lower()}")
+
+    def image(self, dot: bool = False):
+        form = forms.UserUploadImageForm({}, {"image": self.picture(dot)})
+        assert form.is_valid(), form.errors
+
+        return form.cleaned_data["image"]
+
+    def test_placeholder(self):
+        asset = models.ImageAsset.upload_file(self.image(), old_asset=None)
+        thumb = asset.landscape_thumb(40)
+
+        self.assertNotEqual(thumb.id, asset.id)
+
+        for image in (asset, thumb):
+            with Image.open(io.BytesIO(base64.b64decode(image.placeholder))) as im:
+                self.assertEqual(im.format, "JPEG")
+
+            self.assertEqual(image.to_json["placeholder"], image.placeholder)
+
+        # Only the thumbnail's own placeholder is sent
+        self.assertNotIn("placeholder", thumb.to_json["parent"])
+
+    def test_identical_upload(self):
+        first = models.ImageAsset.upload_file(self.image(), old_asset=None)
+        second = models.ImageAsset.upload_file(self.image(), old_asset=None)
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(second.ref_count, 2)
+        self.assertEqual(len(get_storage().objects), 1)
+
+    def test_similar_upload(self):
+        first = models.ImageAsset.upload_file(self.image(), old_asset=None)
+        similar = models.ImageAsset.upload_file(self.image(dot=True), old_asset=None)
+        own = models.ImageAsset.upload_file(self.image(dot=True), old_asset=None, perceptual=False)
+
+        self.assertEqual(similar.id, first.id)
+        self.assertNotEqual(own.id, first.id)
+
+    def test_user_uploads(self):
+        def upload(dot: bool) -> models.UserImage:
+            user = models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+            token = jwt.encode({"id": str(user.id), "aud": settings.AUDIENCE}, settings.SECRET_KEY, algorithm="HS256")
+
+            response = self.client.post("/attractions/api/upload_image", {
+                "token": token,
+                "image": self.picture(dot=dot, image_format="JPEG"),
+            })
+            self.assertEqual(response.json()["status"], "ok")
+
+            return models.UserImage.objects.get(user=user)
+
+        # Similar pictures of different users keep their own assets, the same file is shared
+        first = upload(dot=False)
+        self.assertNotEqual(upload(dot=True).image_id, first.image_id)
+        self.assertEqual(upload(dot=False).image_id, first.image_id)
+
+    def test_delete_shared(self):
+        asset = models.ImageAsset.upload_file(self.image(), old_asset=None)
+        models.ImageAsset.upload_file(self.image(), old_asset=None)
+
+        # Only a reference is released
+        asset.delete()
+        self.assertEqual(models.ImageAsset.objects.get(id=asset.id).ref_count, 1)
+        self.assertEqual(len(get_storage().objects), 1)
+
+        asset.delete()
+        self.assertFalse(models.ImageAsset.objects.filter(id=asset.id).exists())
+        self.assertEqual(get_storage().objects, {})
+
+    def test_added_twice(self):
+        asset = self.museum.add_additional_image(self.image())
+        self.museum.add_additional_image(self.image())
+
+        self.assertEqual(list(self.museum.additional_images.all()), [asset])
+        self.assertEqual(models.ImageAsset.objects.get(id=asset.id).ref_count, 1)
+
+        self.museum.additional_images.remove(asset)
+        models.ImageAsset.delete_many([asset])
+
+        self.assertFalse(models.ImageAsset.objects.filter(id=asset.id).exists())
+        self.assertEqual(get_storage().objects, {})
+
+    def test_replaced_by_itself(self):
+        asset = models.ImageAsset.upload_file(self.image(), old_asset=None)
+        same = models.ImageAsset.upload_file(self.image(), old_asset=asset)
+
+        self.assertEqual(same.id, asset.id)
+        self.assertEqual(models.ImageAsset.objects.get(id=asset.id).ref_count, 1)
+
+    def test_perceptual(self):
+        def original(phash: str):
+            return models.ImageAsset.objects.create(
+                bucket="memory", key=phash, size=1, width=1, height=1, content_hash=phash, perceptual_hash=phash
+            )
+
+        near = original("0f0f0f0f0f0f0f0f")
+        original("f0f0f0f0f0f0f0f0")
+
+        # 4 bits apart, in 4 different digits
+        self.assertEqual(models.ImageAsset.find_duplicate("other", "1e1f0f0f0f0e0f0f"), near)
+        # 5 bits apart
+        self.assertIsNone(models.ImageAsset.find_duplicate("other", "1e1f0f0f0f0e0e0f"))
+
+
+class GridIndexTest(test.TestCase):
+    def setUp(self):
+        self.region = Region.objects.create(name="Region")
+        self.domain = models.MuseumDomain.objects.create(name="Domain")
+        self.index = spatial_index.GridIndex()
+
+    def create(self, name: str, lat: float, long: float) -> models.Museum:
+        return models.Museum.objects.create(
+            name=name, lat=lat, long=long, address="Street", region=self.region, domain=self.domain
+        )
+
+    def query(self):
+        return sorted(entry.id for entry in self.index.query(35, 31, 36, 32, refresh=True))
+
+    def test_refresh(self):
+        moved = self.create("Moved", 31.5, 35.5)
+        deleted = self.create("Deleted", 31.6, 35.6)
+        self.index.build()
+
+        added = self.create("Added", 31.7, 35.7)
+        moved.lat = 40
+        moved.save()
+        deleted.delete()
+
+        self.assertEqual(self.query(), [added.id])
+
+    def test_late_commit(self):
+        museum = self.create("Museum", 31.5, 35.5)
+        self.index.build()
+
+        # A change committed after one with a higher id was read
+        last = self.index.last_change_id
+        models.AttractionChange.objects.create(
+            id=last + 2, attraction_id=museum.id, lat=31.5, long=35.5, content_type_id=museum.content_type_id
+        )
+        self.assertEqual(self.query(), [museum.id])
+        self.assertIn(last + 1, self.index.gaps)
+
+        models.AttractionChange.objects.create(id=last + 1, attraction_id=museum.id)
+        self.assertEqual(self.query(), [])
+        self.assertNotIn(last + 1, self.index.gaps)
+
+    def test_gap_at_build(self):
+        museum = self.create("Museum", 31.5, 35.5)
+        last = models.AttractionChange.objects.latest("id").id
+        models.AttractionChange.objects.create(id=last + 2, attraction_id=0)
+        self.index.build()
+
+        self.assertIn(last + 1, self.index.gaps)
+
+        models.AttractionChange.objects.create(id=last + 1, attraction_id=museum.id)
+        self.assertEqual(self.query(), [])
+
+    def test_edges(self):
+        museum = self.create("Museum", 31.5, 35.5)
+        self.index.build()
+
+        self.assertEqual([entry.id for entry in self.index.query(35, 31, 35.5, 31.5)], [museum.id])
+        self.assertEqual(self.index.query(35, 31, 35.5, 31.5, half_open=True), [])
+        self.assertEqual([entry.id for entry in self.index.query(35.5, 31.5, 36, 32, half_open=True)], [museum.id])
+
+    def test_gap_timeout(self):
+        self.index.build()
+        self.index.gaps = {0: time.monotonic() - spatial_index.GAP_TIMEOUT}
+
+        self.index.refresh()
+        self.assertNotIn(0, self.index.gaps)
+
+
+class TrailTagMaskTest(test.TestCase):
+    def setUp(self):
+        owner = models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+        self.trails = [
+            models.Trail.objects.create(
+                name=f"Trail {i}", lat=31.77, long=35.21, difficulty="E", length=1000, elv_gain=10, owner=owner
+            )
+            for i in range(3)
+        ]
+        self.hiking = models.TrailActivity.objects.create(id=1, name="Hiking")
+        self.cycling = models.TrailActivity.objects.create(id=2, name="Cycling")
+        # Past the mask, matched through the join
+        self.climbing = models.TrailActivity.objects.create(id=70, name="Climbing")
+
+    def masks(self) -> List[int]:
+        return [
+            models.Trail.objects.get(id=trail.id).activities_mask
+            for trail in self.trails
+        ]
+
+    def explore(self, *activities: models.TrailActivity, match: str = "any") -> List[int]:
+        request = test.RequestFactory().get("/", {
+            "activities": [activity.id for activity in activities],
+            "activities_match": match,
+        })
+
+        return sorted(models.Trail.explore_filter(models.Trail.objects.all(), request).values_list("id", flat=True))
+
+    def test_forward(self):
+        trail = self.trails[0]
+
+        trail.activities.add(self.hiking, self.cycling, self.climbing)
+        self.assertEqual(self.masks(), [6, 0, 0])
+
+        trail.activities.remove(self.hiking)
+        self.assertEqual(self.masks(), [4, 0, 0])
+
+        trail.activities.clear()
+        self.assertEqual(self.masks(), [0, 0, 0])
+
+    def test_reverse(self):
+        self.hiking.trails_with_activity.add(self.trails[0], self.trails[1])
+        self.cycling.trails_with_activity.add(self.trails[1])
+        self.assertEqual(self.masks(), [2, 6, 0])
+
+        self.hiking.trails_with_activity.remove(self.trails[1])
+        self.assertEqual(self.masks(), [2, 4, 0])
+
+        # pre_clear remembers the trails, they're no longer related after the clear
+        self.cycling.trails_with_activity.clear()
+        self.assertEqual(self.masks(), [2, 0, 0])
+
+    def test_tag_deleted(self):
+        self.trails[0].activities.add(self.hiking, self.cycling)
+        self.cycling.delete()
+
+        self.assertEqual(self.masks(), [2, 0, 0])
+
+    def test_filter(self):
+        first, second, third = self.trails
+        first.activities.add(self.hiking, self.cycling)
+        second.activities.add(self.hiking, self.climbing)
+        third.activities.add(self.cycling)
+
+        self.assertEqual(self.explore(self.hiking), [first.id, second.id])
+        self.assertEqual(self.explore(self.hiking, self.cycling), [first.id, second.id, third.id])
+        self.assertEqual(self.explore(self.hiking, self.cycling, match="all"), [first.id])
+        self.assertEqual(self.explore(self.climbing), [second.id])
+        self.assertEqual(self.explore(self.cycling, self.climbing), [first.id, second.id, third.id])
+        self.assertEqual(self.explore(self.hiking, self.climbing, match="all"), [second.id])
+        self.assertEqual(self.explore(self.cycling, self.climbing, match="all"), [])
+
+
+class MapZoomTest(test.TestCase):
+    def setUp(self):
+        region = Region.objects.create(name="Region")
+        domain = models.MuseumDomain.objects.create(name="Domain")
+
+        for i in range(2):
+            models.Museum.objects.create(
+                name=f"Museum {i}", lat=31.77, long=35.21, address="Street", region=region, domain=domain
+            )
+
+        # A fresh index, the one of the process may have been built from another test
+        patcher = mock.patch.object(spatial_index, "_index", spatial_index.GridIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, zoom: str):
+        return self.client.get("/attractions/api/map", {
+            "lon_min": 34, "lon_max": 36, "lat_min": 29, "lat_max": 34, "zoom": zoom
+        })
+
+    def test_invalid(self):
+        response = self.get("abc")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["code"], "InvalidZoom")
+
+    def test_invalid_bounds(self):
+        for lon_min in ("abc", "-inf", "nan"):
+            response = self.client.get("/attractions/api/map", {
+                "lon_min": lon_min, "lon_max": 36, "lat_min": 29, "lat_max": 34
+            })
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["code"], "InvalidBounds")
+
+    @mock.patch.object(api_views, "MAP_CLUSTER_THRESHOLD", 1)
+    def test_clamped(self):
+        self.assertEqual(self.get("-5000").json()["clusters"][0]["count"], 2)
+        self.assertEqual(len(self.get("5000").json()["attractions"]), 2)
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ExploreCacheTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.region = Region.objects.create(name="Region")
+        self.domain = models.MuseumDomain.objects.create(name="Domain")
+        self.museum = models.Museum.objects.create(
+            name="Museum", lat=31.77, long=35.21, address="Street", region=self.region, domain=self.domain
+        )
+
+    def names(self, response) -> List[str]:
+        return [museum["name"] for museum in response.json()["museums"]]
+
+    def test_cached(self):
+        first = self.client.get(f"/attractions/api/museums?region_id={self.region.id}&domain_id={self.domain.id}")
+
+        # The same filters in another order, only the version is looked up
+        with self.assertNumQueries(1):
+            second = self.client.get("/attractions/api/museums", {
+                "domain_id": self.domain.id,
+                "region_id": [self.region.id, self.region.id],
+            })
+
+        self.assertEqual(second.content, first.content)
+
+    def test_changed(self):
+        self.assertEqual(self.names(self.client.get("/attractions/api/museums")), ["Museum"])
+
+        self.museum.name = "New museum"
+        self.museum.save()
+
+        self.assertEqual(self.names(self.client.get("/attractions/api/museums")), ["New museum"])
+
+    def test_conditional(self):
+        etag = self.client.get("/attractions/api/museums")["ETag"]
+
+        self.assertEqual(self.client.get("/attractions/api/museums", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.museum.name = "New museum"
+        self.museum.save()
+
+        response = self.client.get("/attractions/api/museums", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(response), ["New museum"])
+
+
+# The keys must fit the column of the database cache
+@test.override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "test_cache"}
+})
+class LongQueryTest(test.TestCase):
+    PARAMS = {"region_id": list(range(1, 200)), "fields": "id,name,lat,long,region,domain"}
+
+    def setUp(self):
+        call_command("createcachetable", verbosity=0)
+
+    def test_keys(self):
+        request = test.RequestFactory().get("/", self.PARAMS)
+
+        for key in (
+            response_cache.explore_key(request, models.Museum),
+            response_cache.combined_explore_key(request, models.get_attraction_classes()),
+            response_cache.tile_key(request, 8, 152, 104),
+        ):
+            self.assertLessEqual(len(key), 250)
+
+    def test_requests(self):
+        for url in ("/attractions/api/museums", "/attractions/api/explore", "/attractions/api/tiles/8/152/104"):
+            self.assertEqual(self.client.get(url, self.PARAMS).status_code, 200)
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class SparseFieldsTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        models.Museum.objects.create(
+            name="Museum", lat=31.77, long=35.21, address="Street",
+            region=Region.objects.create(name="Region"),
+            domain=models.MuseumDomain.objects.create(name="Domain"),
+            main_image=models.ImageAsset.objects.create(bucket="bucket", key="image.png", size=1, width=100, height=100)
+        )
+
+    def museum(self, **params) -> dict:
+        return self.client.get("/attractions/api/museums", params).json()["museums"][0]
+
+    def test_all(self):
+        museum = self.museum()
+
+        self.assertEqual(museum["domain"]["name"], "Domain")
+        self.assertIsNotNone(museum["main_image"])
+
+    def test_fields(self):
+        # The id is always returned
+        self.assertEqual(self.museum(fields="name,lat").keys(), {"id", "name", "lat"})
+        self.assertEqual(self.museum(fields=["name", "main_image"]).keys(), {"id", "name", "main_image"})
+
+    def test_no_thumbnails(self):
+        # The version and the museums, the thumbnails aren't looked up
+        with self.assertNumQueries(2):
+            self.client.get("/attractions/api/museums", {"fields": "name"})
+
+
+class NegotiateTest(TestCase):
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate("gzip, deflate"), "gzip")
+        self.assertEqual(compression.negotiate("gzip;q=0, identity"), None)
+        self.assertEqual(compression.negotiate(""), None)
+
+    @unittest.skipIf(compression.brotli is None, "Brotli isn't installed")
+    def test_brotli(self):
+        self.assertEqual(compression.negotiate("gzip, deflate, br"), "br")
+        self.assertEqual(compression.negotiate("br;q=0, *"), "gzip")
+        self.assertEqual(compression.negotiate("*"), "br")
+
+    def test_without_brotli(self):
+        with mock.patch.object(compression, "brotli", None):
+            self.assertEqual(compression.negotiate("gzip, br"), "gzip")
+            self.assertEqual(compression.negotiate("br"), None)
+
+
+class CompressionMiddlewareTest(TestCase):
+    @staticmethod
+    def get(response):
+        request = test.RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+
+        return CompressionMiddleware(lambda _request: response)(request)
+
+    def test_json(self):
+        response = self.get(JsonResponse({"items": ["item"] * 100}))
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+    def test_html(self):
+        # Would expose the CSRF token to BREACH
+        page = '<form><input type="hidden" name="csrfmiddlewaretoken" value="token"></form>' * 10
+        response = self.get(HttpResponse(page))
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.content.decode(), page)
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CompressedResponseTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        region = Region.objects.create(name="Region")
+        domain = models.MuseumDomain.objects.create(name="Domain")
+
+        for i in range(5):
+            models.Museum.objects.create(
+                name=f"Museum {i}", lat=31.77, long=35.21, address="Street", region=region, domain=domain
+            )
+
+    def get(self, accept_encoding: str):
+        return self.client.get("/attractions/api/museums", HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    def test_gzip(self):
+        plain = self.get("")
+        self.assertFalse(plain.has_header("Content-Encoding"))
+
+        # Once built and once served from the cache
+        for _ in range(2):
+            compressed = self.get("gzip")
+
+            self.assertEqual(compressed["Content-Encoding"], "gzip")
+            self.assertIn("Accept-Encoding", compressed["Vary"])
+            self.assertEqual(gzip.decompress(compressed.content), plain.content)
+
+    @unittest.skipIf(compression.brotli is None, "Brotli isn't installed")
+    def test_brotli(self):
+        plain = self.get("")
+        compressed = self.get("gzip, br")
+
+        self.assertEqual(compressed["Content-Encoding"], "br")
+        self.assertEqual(compression.brotli.decompress(compressed.content), plain.content)
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class CombinedExploreTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.north = Region.objects.create(name="North")
+        south = Region.objects.create(name="South")
+        domain = models.MuseumDomain.objects.create(name="Domain")
+
+        for region, lat in ((self.north, 33), (south, 30)):
+            models.Museum.objects.create(
+                name=f"Museum {region.name}", lat=lat, long=35, address="Street", region=region, domain=domain
+            )
+            models.Winery.objects.create(
+                name=f"Winery {region.name}", lat=lat, long=35, address="Street", region=region
+            )
+
+    def explore(self, **params) -> dict:
+        return self.client.get("/attractions/api/explore", params).json()
+
+    @staticmethod
+    def names(document: dict, key: str) -> List[str]:
+        return [attraction["name"] for attraction in document[key]]
+
+    def test_categories(self):
+        document = self.explore(categories="museums,wineries", region_id=self.north.id)
+
+        self.assertEqual(document.keys(), {"status", "museums", "wineries"})
+        self.assertEqual(self.names(document, "museums"), ["Museum North"])
+        self.assertEqual(self.names(document, "wineries"), ["Winery North"])
+
+    def test_all_categories(self):
+        document = self.explore(limit=1, lat_max=31)
+
+        self.assertIn("trails", document)
+        self.assertEqual(self.names(document, "museums"), ["Museum South"])
+        self.assertEqual(self.names(document, "wineries"), ["Winery South"])
+
+    def test_invalid_bounds(self):
+        for lat_min in ("abc", "nan"):
+            response = self.client.get("/attractions/api/explore", {"lat_min": lat_min})
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["code"], "InvalidBounds")
+
+    def test_region_without_trails(self):
+        models.Trail.objects.create(
+            name="Trail", lat=30, long=35, difficulty="E", length=1000, elv_gain=10,
+            owner=models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+        )
+
+        # Trails don't have a region, they're listed whatever the region
+        document = self.explore(categories="museums,trails", region_id=self.north.id)
+
+        self.assertEqual(self.names(document, "museums"), ["Museum North"])
+        self.assertEqual(self.names(document, "trails"), ["Trail"])
+
+    def test_unknown_category(self):
+        response = self.client.get("/attractions/api/explore", {"categories": "museums,castles"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["code"], "UnknownCategory")
+
+    def test_conditional(self):
+        url = "/attractions/api/explore?categories=museums,wineries"
+        etag = self.client.get(url)["ETag"]
+
+        # Another category doesn't change the response
+        models.Zoo.objects.create(name="Zoo", lat=31, long=35, address="Street", region=self.north)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        models.Winery.objects.filter(name="Winery North").first().save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ExploreCursorTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        region = Region.objects.create(name="Region")
+        domain = models.MuseumDomain.objects.create(name="Domain")
+
+        # Repeated names are ordered by id
+        for name in "CABACBA":
+            models.Museum.objects.create(
+                name=name, lat=31.77, long=35.21, address="Street", region=region, domain=domain
+            )
+
+    def test_pages(self):
+        ids = []
+        params = {"limit": 2, "fields": "name"}
+
+        while True:
+            page = self.client.get("/attractions/api/museums", params).json()
+            ids.extend(museum["id"] for museum in page["museums"])
+
+            if page["next_cursor"] is None:
+                break
+
+            self.assertLess(len(ids), 10)
+            params["cursor"] = page["next_cursor"]
+
+        self.assertEqual(ids, list(models.Museum.objects.order_by("name", "id").values_list("id", flat=True)))
+
+    def test_invalid_cursor(self):
+        # The sort value must be a name
+        for cursor in ("abc", encode_cursor(["M0", "abc"]), encode_cursor([{"a": 1}, 1]), encode_cursor([1, 1])):
+            response = self.client.get("/attractions/api/museums", {"limit": 2, "cursor": cursor})
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["code"], "InvalidCursor")
+
+    def test_invalid_limit(self):
+        for limit in ("abc", "0"):
+            response = self.client.get("/attractions/api/museums", {"limit": limit})
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["code"], "InvalidLimit")
+
+    # PostgreSQL scans tables this small anyway, run explain_queries with the default rows there
+    @unittest.skipIf(connection.vendor == "postgresql", "The planner scans small tables")
+    def test_plans(self):
+        call_command("explain_queries", rows=300, stdout=io.StringIO())
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class FacetTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.north = Region.objects.create(name="North")
+        self.south = Region.objects.create(name="South")
+        self.art = models.MuseumDomain.objects.create(name="Art")
+        self.history = models.MuseumDomain.objects.create(name="History")
+
+        for region, domain in ((self.north, self.art), (self.north, self.history), (self.south, self.art)):
+            models.Museum.objects.create(
+                name="Museum", lat=31.77, long=35.21, address="Street", region=region, domain=domain
+            )
+
+    def facets(self, key: str, **params) -> dict:
+        response = self.client.get(f"/attractions/api/{key}", params).json()
+
+        return {
+            name: {value["id"]: value["count"] for value in values}
+            for name, values in response["facets"].items()
+        }
+
+    def test_counts(self):
+        self.assertEqual(self.facets("museums", facets="region,domain"), {
+            "region": {self.north.id: 2, self.south.id: 1},
+            "domain": {self.art.id: 2, self.history.id: 1},
+        })
+
+    def test_filtered(self):
+        self.assertEqual(self.facets("museums", facets="domain", region_id=self.north.id), {
+            "domain": {self.art.id: 1, self.history.id: 1},
+        })
+
+    def test_many_to_many(self):
+        owner = models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+        hiking = models.TrailActivity.objects.create(name="Hiking")
+        cycling = models.TrailActivity.objects.create(name="Cycling")
+
+        for difficulty, activities in (("E", [hiking, cycling]), ("H", [hiking]), ("H", [cycling])):
+            trail = models.Trail.objects.create(
+                name="Trail", lat=31.77, long=35.21, difficulty=difficulty, length=1000, elv_gain=10, owner=owner
+            )
+            trail.activities.add(*activities)
+
+        # The other activities of the matching trails are counted too
+        self.assertEqual(self.facets("trails", facets="activities,difficulty", activities=hiking.id), {
+            "activities": {hiking.id: 2, cycling.id: 1},
+            "difficulty": {"E": 1, "H": 1},
+        })
+
+    def test_unknown(self):
+        response = self.client.get("/attractions/api/museums", {"facets": "region,color"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["code"], "UnknownFacet")
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class BatchDetailTest(test.TestCase):
+    def setUp(self):
+        cache.clear()
+
+        region = Region.objects.create(name="Region")
+        self.museum = models.Museum.objects.create(
+            name="Museum", lat=31.77, long=35.21, address="Street", region=region,
+            domain=models.MuseumDomain.objects.create(name="Domain")
+        )
+        self.winery = models.Winery.objects.create(
+            name="Winery", lat=31.77, long=35.21, address="Street", region=region
+        )
+
+    def details(self, ids: str):
+        return self.client.get("/attractions/api/details", {"ids": ids})
+
+    def test_order(self):
+        missing = self.winery.id + 1000
+        response = self.details(f"{self.winery.id},{self.museum.id},{missing},{self.winery.id}").json()
+
+        self.assertEqual([attraction["id"] for attraction in response["attractions"]], [self.winery.id, self.museum.id])
+        self.assertEqual(response["missing"], [missing])
+
+    def test_single_document(self):
+        single = self.client.get(f"/attractions/api/museums/{self.museum.id}").json()["museum"]
+
+        self.assertEqual(self.details(str(self.museum.id)).json()["attractions"], [single])
+
+    def test_cached(self):
+        ids = f"{self.museum.id},{self.winery.id}"
+        first = self.details(ids)
+
+        # The categories of the ids, the documents come from the cache
+        with self.assertNumQueries(1):
+            second = self.details(ids)
+
+        self.assertEqual(second.content, first.content)
+
+    def test_invalid(self):
+        too_many = ",".join(map(str, range(1, api_views.MAX_DETAILS + 2)))
+
+        for ids in ("", "abc", too_many, "99999999999999999999999", f"{self.museum.id},-{2 ** 63 + 1}"):
+            response = self.details(ids)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["code"], "InvalidIds")
+
+
+@test.override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class TileTest(test.TestCase):
+    JERUSALEM = (31.77, 35.21)
+    HAIFA = (32.8, 35.0)
+
+    def setUp(self):
+        cache.clear()
+
+        patcher = mock.patch.object(spatial_index, "_index", spatial_index.GridIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.museum = models.Museum.objects.create(
+            name="Museum", lat=self.JERUSALEM[0], long=self.JERUSALEM[1], address="Street",
+            region=Region.objects.create(name="Region"),
+            domain=models.MuseumDomain.objects.create(name="Domain")
+        )
+
+    def tile(self, location, **headers):
+        x, y = tiles.tile_for(*location, 10)
+
+        return self.client.get(f"/attractions/api/tiles/10/{x}/{y}", **headers)
+
+    def ids(self, location) -> List[int]:
+        return [attraction["id"] for attraction in self.tile(location).json()["attractions"]]
+
+    def test_moved(self):
+        self.assertEqual(self.ids(self.JERUSALEM), [self.museum.id])
+        self.assertEqual(self.ids(self.HAIFA), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.museum.lat, self.museum.long = self.HAIFA
+            self.museum.save()
+
+        # Both the tile it left and the one it moved to are rebuilt
+        self.assertEqual(self.ids(self.JERUSALEM), [])
+        self.assertEqual(self.ids(self.HAIFA), [self.museum.id])
+
+    def test_other_tiles_kept(self):
+        self.tile(self.HAIFA)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.museum.name = "New museum"
+            self.museum.save()
+
+        with self.assertNumQueries(0):
+            self.tile(self.HAIFA)
+
+    def test_conditional(self):
+        etag = self.tile(self.JERUSALEM)["ETag"]
+        self.assertEqual(self.tile(self.JERUSALEM, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.museum.name = "New museum"
+            self.museum.save()
+
+        self.assertEqual(self.tile(self.JERUSALEM, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_invalid(self):
+        response = self.client.get(f"/attractions/api/tiles/{tiles.MAX_ZOOM + 1}/0/0")
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["code"], "InvalidTile")
+
+
+class SearchRankTest(test.TestCase):
+    def setUp(self):
+        self.region = Region.objects.create(name="Region")
+        self.domain = models.MuseumDomain.objects.create(name="Domain")
+
+    def create(self, name: str, description: str = "", address: str = "Street"):
+        return models.Museum.objects.create(
+            name=name, lat=31.77, long=35.21, address=address, description=description,
+            region=self.region, domain=self.domain
+        )
+
+    @staticmethod
+    def names(q: str) -> List[str]:
+        return list(search_attractions(q).query_set.values_list("name", flat=True))
+
+    @unittest.skipIf(connection.vendor == "postgresql", "PostgreSQL ranks the matches")
+    def test_substring(self):
+        self.create("Israel Museum")
+        self.create("Museum of Art", "Israel")
+
+        self.assertEqual(self.names("rael mus"), ["Israel Museum"])
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "Ranked search needs PostgreSQL")
+    def test_weights(self):
+        # The name outweighs the address, which outweighs the description
+        self.create("Hall", "Tower tower tower")
+        self.create("Tower Museum")
+        self.create("Gallery", address="Tower street")
+
+        self.assertEqual(self.names("tower"), ["Tower Museum", "Gallery", "Hall"])
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "Ranked search needs PostgreSQL")
+    def test_words(self):
+        self.create("Israel Museum")
+        self.create("Israel Winery")
+        self.create("Museum of Art")
+
+        # Every word, the last one as a prefix
+        self.assertEqual(self.names("israel mus"), ["Israel Museum"])
+        self.assertEqual(self.names("  "), [])
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "Ranked search needs PostgreSQL")
+    def test_renamed(self):
+        museum = self.create("Old Museum")
+
+        museum.name = "New Museum"
+        museum.save()
+
+        self.assertEqual(self.names("new"), ["New Museum"])
+        self.assertFalse(models.Attraction.objects.filter(
+            search_vector=SearchQuery("old", config=SEARCH_CONFIG)
+        ).exists())
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "Ranked search needs PostgreSQL")
+    def test_typo(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+
+            if cursor.fetchone() is None:
+                self.skipTest("pg_trgm isn't available")
+
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+        self.create("Israel Museum")
+        self.create("Tower of David")
+
+        self.assertEqual(self.names("israle museum"), ["Israel Museum"])
+
+
+class UserListPaginationTest(test.TestCase):
+    def setUp(self):
+        region = Region.objects.create(name="Region")
+        domain = models.MuseumDomain.objects.create(name="Domain")
+        self.user = models.GoogleUser.objects.create(id=uuid.uuid4(), anonymized=True)
+        self.token = jwt.encode({"id": str(self.user.id), "aud": settings.AUDIENCE}, settings.SECRET_KEY, algorithm="HS256")
+
+        self.museums = [
+            models.Museum.objects.create(
+                name=f"Museum {i}", lat=31.77, long=35.21, address="Street", region=region, domain=domain
+            )
+            for i in range(5)
+        ]
+
+        # The first two were visited at the same time, ordered by id
+        for i, museum in enumerate(self.museums):
+            when = datetime(2022, 5, 15, 6, 8, max(i, 1), 123456, tzinfo=pytz.UTC)
+
+            models.History.objects.create(user=self.user, attraction=museum, created=when, last_visited=when)
+            models.Favorite.objects.create(user=self.user, attraction=museum, created=when)
+
+    def post(self, url: str, **data):
+        return self.client.post(url, json.dumps({"token": self.token, **data}), content_type="application/json")
+
+    def walk(self, url: str) -> List[int]:
+        ids = []
+        cursor = None
+
+        while True:
+            page = self.post(url, limit=2, cursor=cursor).json()
+            ids.extend(museum["id"] for museum in page["museums"])
+
+            if page["next_cursor"] is None:
+                return ids
+
+            self.assertLess(len(ids), 10)
+            cursor = page["next_cursor"]
+
+    def test_pages(self):
+        # Latest first
+        expected = [museum.id for museum in reversed(self.museums)]
+
+        self.assertEqual(self.walk("/attractions/api/history/museums"), expected)
+        self.assertEqual(self.walk("/attractions/api/favorites/museums"), expected)
+
+    def test_invalid(self):
+        for url in ("/attractions/api/history/museums", "/attractions/api/favorites/museums"):
+            # The sort value must be a date
+            for cursor in (encode_cursor(["yesterday", 1]), encode_cursor([5, 1])):
+                response = self.post(url, limit=2, cursor=cursor)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()["code"], "InvalidCursor")
+
+            self.assertEqual(self.post(url, limit="abc").json()["code"], "InvalidLimit")
+
+
+class NearbyTest(test.TestCase):
+    def setUp(self):
+        region = Region.objects.create(name="Region")
+        domain = models.MuseumDomain.objects.create(name="Domain")
+
+        # About 100m, 500m, 5km and 50km north of the point, the farthest is outside the first search
+        self.museums = [
+            models.Museum.objects.create(
+                name=f"Museum {offset}", lat=31.77 + offset, long=35.21, address="Street", region=region, domain=domain
+            )
+            for offset in (0.045, 0.0009, 0.45, 0.0045)
+        ]
+        self.expected = [self.museums[i].id for i in (1, 3, 0, 2)]
+
+    def nearby(self, **params):
+        return self.client.get("/attractions/api/nearby", {"lat": 31.77, "long": 35.21, **params})
+
+    def test_nearest(self):
+        attractions = self.nearby(limit=4).json()["attractions"]
+
+        self.assertEqual([attraction["id"] for attraction in attractions], self.expected)
+        self.assertEqual([attraction["distance"] for attraction in attractions], sorted(
+            attraction["distance"] for attraction in attractions
+        ))
+        self.assertAlmostEqual(attractions[0]["distance"], 100, delta=5)
+
+        attractions = self.nearby(limit=2).json()["attractions"]
+
+        self.assertEqual([attraction["id"] for attraction in attractions], self.expected[:2])
+
+    def test_radius(self):
+        attractions = self.nearby(radius=1000).json()["attractions"]
+
+        self.assertEqual([attraction["id"] for attraction in attractions], self.expected[:2])
+
+        attractions = self.nearby(radius=10000, limit=1).json()["attractions"]
+
+        self.assertEqual([attraction["id"] for attraction in attractions], self.expected[:1])
+
+    def test_invalid(self):
+        for params in ({"radius": "nan"}, {"radius": "inf"}, {"radius": "0"}, {"radius": "-1"}, {"lat": "nan"}):
+            response = self.nearby(**params)
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["code"], "InvalidLocation")
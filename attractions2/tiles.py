@@ -0,0 +1,44 @@
+"""
+Slippy map (web mercator z/x/y) tile math
+"""
+import math
+from typing import Tuple
+
+# Deepest zoom level tiles are served (and invalidated) for
+MAX_ZOOM = 20
+
+# Web mercator can't represent the poles, the map ends at this latitude
+MAX_LATITUDE = 85.0511287798
+
+
+def is_valid(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _latitude(y: int, z: int) -> float:
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2 ** z))))
+
+
+def bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    The (west, south, east, north) edges of the tile in degrees
+    """
+    return (
+        x / 2 ** z * 360 - 180,
+        _latitude(y + 1, z),
+        (x + 1) / 2 ** z * 360 - 180,
+        _latitude(y, z),
+    )
+
+
+def tile_for(lat: float, long: float, z: int) -> Tuple[int, int]:
+    """
+    The (x, y) of the tile holding the point at zoom z
+    """
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    n = 2 ** z
+
+    x = int((long + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
@@ -8,6 +8,8 @@ register_converter(FilterModelConverter, "filter")
 
 urlpatterns = [
                   path("", views.homepage, name="attractions_homepage"),
+                  path("api/explore", api_views.combined_explore),
+                  path("api/details", api_views.get_details),
                   path("api/<model:model>", api_views.get_explore),
                   path("api/<model:model>/<int:attraction_id>", api_views.get_single),
                   path("api/login", api_views.login),
@@ -24,7 +26,10 @@ urlpatterns = [
                   path("api/trail/upload", api_views.upload_start),
                   path("api/upload_image", api_views.upload_image),
                   path("api/map", api_views.map_attractions),
+                  path("api/nearby", api_views.nearby),
+                  path("api/tiles/<int:z>/<int:x>/<int:y>", api_views.get_tile),
                   path("api/search", api_views.search),
+                  path("api/suggest", api_views.suggest),
                   path("api/tours/availability/<int:tour_id>/<int:year>/<int:month>", api_views.availability),
                   path("api/tours/available/<int:tour_id>/<int:year>/<int:month>", api_views.available),
                   path("api/tours/reserve", api_views.tour_reserve),
@@ -1,7 +1,5 @@
 from typing import NoReturn
 
-import boto3
-from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.core.paginator import Paginator
 from django.http import HttpResponse, JsonResponse
@@ -11,6 +9,7 @@ from django.views.decorators.csrf import csrf_exempt
 from attractions2 import forms, models
 from attractions2.base_views import EditView, ManagedEditView
 from attractions2.pager import Pager
+from attractions2.storage import get_storage
 
 
 @staff_member_required
@@ -207,17 +206,15 @@ class EditTrail(EditView):
         # id of the trail to be set
         coordinates = cleaned_data["coordinates"]
         if coordinates is not None:
-            s3 = boto3.client("s3", **settings.ASSETS["config"])
-            key = settings.ASSETS["prefix"] + "trails/" + str(instance.id) + ".csv.gz"
-            bucket = settings.ASSETS["bucket"]
+            storage = get_storage()
 
             coordinates.seek(0)
-            s3.upload_fileobj(coordinates, bucket, key, ExtraArgs={
-                "ContentType": "text/csv",
-                "ContentEncoding": "gzip",
-                "ACL": "public-read",
-                "CacheControl": "public, max-age=2592000"
-            })
+            storage.upload(
+                coordinates,
+                storage.trail_key(instance.id),
+                content_type="text/csv",
+                content_encoding="gzip"
+            )
 
             instance.long = cleaned_data["long"]
             instance.lat = cleaned_data["lat"]
@@ -286,14 +283,7 @@ def attraction_upload(request, attraction_id: int):
         form = forms.UserUploadImageForm(request.POST, request.FILES)
 
         if form.is_valid():
-            image = models.ImageAsset.upload_file(
-                form.cleaned_data["image"],
-                old_asset=None
-            )
-
-            image.save()
-
-            attraction.additional_images.add(image)
+            image = attraction.add_additional_image(form.cleaned_data["image"])
 
             image_data = image.to_json
             image_data["id"] = image.id
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
+import os
 import uuid
 from pathlib import Path
 
@@ -31,6 +32,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'attractions2',
     "django_bootstrap5",
     "corsheaders"
@@ -38,6 +40,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'hland.middleware.HealthCheckMiddleware',
+    'hland.middleware.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -90,6 +93,19 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# The response, detail and tile caches are invalidated by deleting keys, so every
+# process has to share the cache. Gunicorn runs a single worker by default, which can
+# keep the cache in memory, several workers need a shared backend (see the README).
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("HLAND_CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("HLAND_CACHE_LOCATION", ""),
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
@@ -1,4 +1,7 @@
 from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from attractions2 import compression
 
 
 class HealthCheckMiddleware:
@@ -9,3 +12,43 @@ class HealthCheckMiddleware:
         if request.path == '/health':
             return HttpResponse('ok')
         return self.get_response(request)
+
+
+class CompressionMiddleware:
+    """
+    Compress responses with brotli or gzip depending on Accept-Encoding, responses
+    which are already encoded (like the precompressed cached ones) are left alone
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        if response.streaming or response.has_header("Content-Encoding"):
+            return response
+
+        if not compression.is_compressible(response.get("Content-Type", ""), len(response.content)):
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        coding = compression.negotiate(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if coding is None:
+            return response
+
+        compressed = compression.compress(response.content, coding)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response["Content-Length"] = str(len(compressed))
+        response["Content-Encoding"] = coding
+
+        # The representation changed, so a strong ETag no longer applies
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+
+        return response
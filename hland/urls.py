@@ -31,3 +31,6 @@ if settings.DEBUG:
 
     urlpatterns.append(path('__debug__/', include(urls)))
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+
+    if settings.ASSETS.get("backend") == "local":
+        urlpatterns += static(settings.ASSETS.get("base_url", "/assets/"), document_root=settings.ASSETS["root"])